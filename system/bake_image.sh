@@ -0,0 +1,102 @@
+#!/bin/bash
+# Builds the node image used for the containers of a system job and prints its name.
+# The image is committed from a container provisioned with deps.yml and is keyed by a hash of deps.yml and the base
+# image, an existing image with the same key is reused so it is only provisioned again when either changes.
+# The infrastructure roles are not baked, they come from the lint jobs' artifacts and install and configure in the
+# same tasks so every build still runs them.
+# An image that failed to bake is not tried again for the same key for BAKE_RETRY_HOURS, so a broken bake doesn't add
+# its time to every build that then falls back to the bare image.
+#
+# Usage: bake_image.sh [base image]
+# Run from the system directory
+
+BASE_IMAGE=${1:-ubuntu-upstart:14.04}
+REPOSITORY=monasca-ci/node
+LOCK=/var/tmp/monasca-ci/bake.lock
+FAILED_DIR=/var/tmp/monasca-ci/bake-failed
+BAKE_RETRY_HOURS=${BAKE_RETRY_HOURS:-24}
+
+hash_files() {
+    find "$@" -type f -print0 | sort -z | xargs -0 sha1sum | sha1sum | cut -c1-12
+}
+
+image_exists() {
+    docker inspect "$1" > /dev/null 2>&1
+}
+
+failed_marker() {
+    echo $FAILED_DIR/${1//[:\/]/_}
+}
+
+# True when baking image $1 failed within the last BAKE_RETRY_HOURS
+failed_recently() {
+    local marker=$(failed_marker $1)
+    [ -n "$(find $marker -mmin -$((BAKE_RETRY_HOURS * 60)) 2> /dev/null)" ]
+}
+
+# Bakes image $3 from image $1 with playbook $2 unless that failed recently, a failure is recorded
+bake_unless_failed() {
+    local image=$3
+    if failed_recently $image; then
+        echo "Not baking $image, it failed at $(date -r $(failed_marker $image)), retried after ${BAKE_RETRY_HOURS}h" >&2
+        return 1
+    fi
+    echo "Baking $image" >&2
+    if ! bake "$@"; then
+        mkdir -p $FAILED_DIR
+        touch $(failed_marker $image)
+        return 1
+    fi
+    rm -f $(failed_marker $image)
+}
+
+# Provisions a container started from image $1 with playbook $2 and commits it as image $3
+bake() {
+    local from=$1 playbook=$2 image=$3
+    local name=bake_${image##*:}_$$
+    docker run -d --name $name $from > /dev/null || return 1
+    local ip=$(docker inspect -f '{{ .NetworkSettings.IPAddress }}' $name)
+    local deadline=$((SECONDS + 120))
+    until timeout 2 bash -c "exec 3<>/dev/tcp/$ip/22" 2> /dev/null; do
+        if [ $SECONDS -ge $deadline ]; then
+            echo "ssh on $name was not ready" >&2
+            docker rm -f $name > /dev/null
+            return 1
+        fi
+        sleep 1
+    done
+
+    local inventory=$(mktemp)
+    cat > $inventory <<INVENTORY
+[monasca_master]
+$ip ansible_ssh_user=root ansible_ssh_pass=docker.io
+
+[monasca_workers]
+$ip ansible_ssh_user=root ansible_ssh_pass=docker.io
+
+[monasca:children]
+monasca_master
+monasca_workers
+INVENTORY
+    ansible-playbook -i $inventory $playbook >&2
+    local rc=$?
+    rm -f $inventory
+    if [ $rc -eq 0 ]; then
+        docker commit $name $image > /dev/null || rc=1
+    fi
+    docker rm -f $name > /dev/null
+    return $rc
+}
+
+deps_hash=$( (echo $BASE_IMAGE; hash_files deps.yml) | sha1sum | cut -c1-12)
+deps_image=$REPOSITORY:deps-$deps_hash
+
+# Concurrent jobs wait for each other rather than baking the same image twice
+mkdir -p $(dirname $LOCK)
+exec 9> $LOCK
+flock 9
+
+if ! image_exists $deps_image; then
+    bake_unless_failed $BASE_IMAGE deps.yml $deps_image || exit 1
+fi
+echo $deps_image
@@ -1,38 +1,194 @@
+import csv
+import json
+import os
+import tempfile
 import time
 
+# Base path of the timing report, <path>.json and <path>.csv are written
+REPORT_ENV = 'PROFILE_TASKS_REPORT'
+
+# When a task has several results for a host, as with with_items, the
+# host's status is the most severe of them
+STATUS_SEVERITY = ['skipped', 'ok', 'failed', 'unreachable']
+
+
+def encode(value):
+    """
+    The csv module only writes byte strings
+    """
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
 
 class CallbackModule(object):
     """
     A plugin for timing tasks
+
+    Every task is kept, in the order it ran, with its play and role. The
+    time each host finished the task is recorded as well. The runner
+    callbacks may be called in forked worker processes so host results
+    are appended to an events file which is read back at the end.
     """
     def __init__(self):
-        self.stats = {}
+        self.tasks = []
         self.current = None
+        self.play_name = None
+        self.start = time.time()
+        fd, self.events_path = tempfile.mkstemp(prefix='profile_tasks.')
+        os.close(fd)
+
+    def _start_task(self, name, role=None):
+        """
+        Ends the running task and starts timing the next one
+        """
+        self._end_task()
+        if role is None and ' | ' in name:
+            # Role tasks are named '<role> | <task>'
+            role, name = name.split(' | ', 1)
+        self.current = {
+            'index': len(self.tasks),
+            'play': self.play_name,
+            'role': role,
+            'name': name,
+            'start': time.time(),
+            'hosts': {},
+        }
+        self.tasks.append(self.current)
+
+    def _end_task(self):
+        if self.current is not None:
+            self.current['end'] = time.time()
+            self.current['duration'] = (self.current['end'] -
+                                         self.current['start'])
+            self.current = None
+
+    def _host_event(self, host, status):
+        """
+        Records when a host finished the running task
+        """
+        if self.current is None:
+            return
+        event = json.dumps({'task': self.current['index'], 'host': host,
+                            'status': status, 'time': time.time()})
+        with open(self.events_path, 'a') as events:
+            events.write(event + '\n')
+
+    def playbook_on_play_start(self, name):
+        self._end_task()
+        self.play_name = name
+
+    def playbook_on_setup(self):
+        self._start_task('GATHERING FACTS')
 
     def playbook_on_task_start(self, name, is_conditional):
         """
         Logs the start of each task
         """
-        if self.current is not None:
-            # Record the running time of the last executed task
-            self.stats[self.current] = time.time() - self.stats[self.current]
+        self._start_task(name)
+
+    def playbook_on_handler_task_start(self, name):
+        self._start_task(name)
+
+    def runner_on_ok(self, host, res):
+        self._host_event(host, 'ok')
+
+    def runner_on_failed(self, host, res, ignore_errors=False):
+        self._host_event(host, 'failed')
+
+    def runner_on_skipped(self, host, item=None):
+        self._host_event(host, 'skipped')
+
+    def runner_on_unreachable(self, host, res):
+        self._host_event(host, 'unreachable')
 
-        # Record the start time of the current task
-        self.current = name
-        self.stats[self.current] = time.time()
+    def _read_host_events(self):
+        try:
+            with open(self.events_path) as events:
+                lines = events.readlines()
+            os.remove(self.events_path)
+        except (IOError, OSError):
+            return
+        for line in lines:
+            event = json.loads(line)
+            task = self.tasks[event['task']]
+            host = task['hosts'].setdefault(
+                event['host'], {'status': event['status'], 'end': 0})
+            host['end'] = max(host['end'], event['time'])
+            if STATUS_SEVERITY.index(event['status']) > \
+                    STATUS_SEVERITY.index(host['status']):
+                host['status'] = event['status']
+        for task in self.tasks:
+            for host in task['hosts'].values():
+                host['duration'] = host['end'] - task['start']
+
+    def _totals(self, key):
+        totals = {}
+        for task in self.tasks:
+            if task[key] is not None:
+                totals[task[key]] = (totals.get(task[key], 0) +
+                                     task['duration'])
+        return totals
+
+    def _host_totals(self):
+        totals = {}
+        for task in self.tasks:
+            for name, host in task['hosts'].items():
+                totals[name] = totals.get(name, 0) + host['duration']
+        return totals
+
+    def _write_report(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        end = time.time()
+        report = {
+            'start': self.start,
+            'end': end,
+            'duration': end - self.start,
+            'tasks': self.tasks,
+            'plays': self._totals('play'),
+            'roles': self._totals('role'),
+            'hosts': self._host_totals(),
+        }
+        with open(path + '.json', 'w') as output:
+            json.dump(report, output, indent=2)
+
+        with open(path + '.csv', 'wb') as output:
+            writer = csv.writer(output)
+            writer.writerow(['index', 'play', 'role', 'task', 'host',
+                             'status', 'start', 'end', 'duration'])
+            for task in self.tasks:
+                rows = [(name, host['status'], host['end'], host['duration'])
+                        for name, host in sorted(task['hosts'].items())]
+                if not rows:
+                    rows = [('', '', task['end'], task['duration'])]
+                for host, status, host_end, duration in rows:
+                    writer.writerow([
+                        task['index'], encode(task['play']),
+                        encode(task['role']), encode(task['name']),
+                        encode(host), status, '%.3f' % task['start'],
+                        '%.3f' % host_end, '%.3f' % duration])
 
     def playbook_on_stats(self, stats):
         """
         Prints the timings
         """
         # Record the timing of the very last task
-        if self.current is not None:
-            self.stats[self.current] = time.time() - self.stats[self.current]
+        self._end_task()
+        self._read_host_events()
+
+        report_path = os.environ.get(REPORT_ENV)
+        if report_path:
+            self._write_report(report_path)
 
         # Sort the tasks by their running time
         results = sorted(
-            self.stats.items(),
-            key=lambda value: value[1],
+            self.tasks,
+            key=lambda task: task['duration'],
             reverse=True,
         )
 
@@ -40,10 +196,13 @@ class CallbackModule(object):
         results = results[:10]
 
         # Print the timings
-        for name, elapsed in results:
+        for task in results:
+            name = task['name']
+            if task['role'] is not None:
+                name = u'{0} | {1}'.format(task['role'], name)
             print(
-                "{0:-<70}{1:->9}".format(
-                    '{0} '.format(name),
-                    ' {0:.02f}s'.format(elapsed),
+                u"{0:-<70}{1:->9}".format(
+                    u'{0} '.format(name),
+                    ' {0:.02f}s'.format(task['duration']),
                 )
             )
@@ -0,0 +1,83 @@
+#!/bin/bash
+# Starts the Openstack container and the Monasca node containers of a build all at once, looks up every IP with one
+# docker inspect and waits for ssh on the nodes in parallel.
+# Prints "<container name> <ip>" for the Openstack container then each node in the order given.
+#
+# Usage: docker_nodes.sh <job name> <build number> <comma separated nodes> [openstack tag] [node image]
+# The same names, images, ports and volumes as the docker module tasks these replaced are used.
+
+JOB_NAME=$1
+BUILD_NUMBER=$2
+NODES=$3
+OPENSTACK_TAG=${4:-latest}
+NODE_IMAGE=${5:-ubuntu-upstart:14.04}
+SSH_TIMEOUT=${SSH_TIMEOUT:-120}
+
+if [ -z "$JOB_NAME" -o -z "$BUILD_NUMBER" -o -z "$NODES" ]; then
+    echo "Usage: $0 <job name> <build number> <comma separated nodes> [openstack tag] [node image]" >&2
+    exit 1
+fi
+
+OPENSTACK_NAME=${JOB_NAME}_openstack_${BUILD_NUMBER}
+NODE_NAMES=()
+for node in ${NODES//,/ }; do
+    NODE_NAMES+=(${JOB_NAME}_${node}_${BUILD_NUMBER})
+done
+
+# Runs the container unless it already exists, in which case it is started if it is not running
+start_container() {
+    local name=$1
+    shift
+    if docker inspect "$name" > /dev/null 2>&1; then
+        docker start "$name" > /dev/null
+    else
+        docker run -d --name "$name" "$@" > /dev/null
+    fi
+}
+
+wait_for_ssh() {
+    local ip=$1
+    local deadline=$((SECONDS + SSH_TIMEOUT))
+    until timeout 2 bash -c "exec 3<>/dev/tcp/$ip/22" 2> /dev/null; do
+        if [ $SECONDS -ge $deadline ]; then
+            echo "ssh on $ip was not ready after ${SSH_TIMEOUT}s" >&2
+            return 1
+        fi
+        sleep 1
+    done
+}
+
+# Waits for all the given pids, fails if any of them failed
+wait_all() {
+    local failed=0
+    for pid in "$@"; do
+        wait $pid || failed=1
+    done
+    return $failed
+}
+
+pids=()
+# External port mapping isn't needed for container -> container communication, the UI on port 80 is skipped for now
+start_container $OPENSTACK_NAME -p 5000:51${BUILD_NUMBER} -p 35357:31${BUILD_NUMBER} monasca/openstack:$OPENSTACK_TAG &
+pids+=($!)
+for name in "${NODE_NAMES[@]}"; do
+    start_container $name -p 8080:81${BUILD_NUMBER} -v /var/tmp:/var/pip-cache $NODE_IMAGE &
+    pids+=($!)
+done
+wait_all "${pids[@]}" || exit 1
+
+# In Ansible jinja2 uses {{ so this command lives in a script rather than the playbook
+ips=$(docker inspect -f '{{ .NetworkSettings.IPAddress }}' $OPENSTACK_NAME "${NODE_NAMES[@]}") || exit 1
+ips=($ips)
+
+pids=()
+for ip in "${ips[@]:1}"; do
+    wait_for_ssh $ip &
+    pids+=($!)
+done
+wait_all "${pids[@]}" || exit 1
+
+names=($OPENSTACK_NAME "${NODE_NAMES[@]}")
+for i in "${!names[@]}"; do
+    echo "${names[$i]} ${ips[$i]}"
+done
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+#
+"""sync_artifacts
+    Copies the artifacts of the last successful build of each project into
+    the workspace, like the copyartifact plugin, but only downloads those
+    that changed.
+
+    Artifacts are kept in a store shared by every job on the Jenkins host,
+    one directory per project and upstream build number. A project is only
+    downloaded when its last successful build is not in the store yet, the
+    downloads are made concurrently and each project is locked while it is
+    downloaded so concurrent jobs fetch it once. The files are then copied
+    into the target directory.
+
+    The Jenkins URL and credentials come from the JENKINS_URL, JENKINS_USER
+    and JENKINS_API_TOKEN environment variables.
+"""
+
+from __future__ import print_function
+import argparse
+import base64
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+import sys
+import time
+import urllib
+import urllib2
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+STORE = '/var/tmp/monasca-ci/artifacts'
+# archive.zip holds the artifacts under this directory
+ARCHIVE_PREFIX = 'archive/'
+SYNC_ATTEMPTS = 3
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('projects', nargs='+',
+                        help='Jenkins jobs to copy the artifacts of')
+    parser.add_argument('--target', default='artifacts',
+                        help='directory to copy the artifacts to')
+    parser.add_argument('--store', default=STORE,
+                        help='artifact store shared by the jobs')
+    parser.add_argument('--jenkins-url', default=os.environ.get('JENKINS_URL'),
+                        help='defaults to $JENKINS_URL')
+    parser.add_argument('--workers', type=int, default=6,
+                        help='number of projects to download at once')
+    parser.add_argument('--keep', type=int, default=3,
+                        help='builds of each project to keep in the store')
+    return parser.parse_args()
+
+
+class Jenkins(object):
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.headers = {}
+        user = os.environ.get('JENKINS_USER')
+        token = os.environ.get('JENKINS_API_TOKEN')
+        if user and token:
+            self.headers['Authorization'] = 'Basic ' + base64.b64encode(
+                '{}:{}'.format(user, token))
+
+    def open(self, path):
+        request = urllib2.Request(self.url + path, headers=self.headers)
+        return urllib2.urlopen(request, timeout=60)
+
+    def last_successful_build(self, project):
+        """Returns the build number, None if there is no successful build"""
+        path = '/job/{}/lastSuccessfulBuild/api/json?tree=number'.format(
+            urllib.quote(project))
+        try:
+            return json.load(self.open(path))['number']
+        except urllib2.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+
+    def download_archive(self, project, build, path):
+        response = self.open('/job/{}/{}/artifact/*zip*/archive.zip'.format(
+                             urllib.quote(project), build))
+        with open(path, 'wb') as archive:
+            shutil.copyfileobj(response, archive)
+
+
+class SyncResult(object):
+    def __init__(self, project, build=None, previous=None, downloaded=False,
+                 elapsed=0.0, error=None):
+        self.project = project
+        self.build = build
+        self.previous = previous
+        self.downloaded = downloaded
+        self.elapsed = elapsed
+        self.error = error
+
+
+@contextlib.contextmanager
+def locked(project_dir, operation):
+    """Holds the project's lock, shared while copying from the store and
+    exclusive while changing it"""
+    with open(os.path.join(project_dir, '.lock'), 'a') as lock:
+        fcntl.flock(lock, operation)
+        yield
+
+
+def download(jenkins, project_dir, project, build):
+    """Downloads and extracts the build's artifacts into the store, must be
+    called holding the exclusive lock"""
+    build_dir = os.path.join(project_dir, str(build))
+    partial = build_dir + '.partial'
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    archive_path = os.path.join(partial, 'archive.zip')
+    jenkins.download_archive(project, build, archive_path)
+    with zipfile.ZipFile(archive_path) as archive:
+        for member in archive.infolist():
+            name = member.filename
+            if name.endswith('/') or not name.startswith(ARCHIVE_PREFIX):
+                continue
+            destination = os.path.join(partial, name[len(ARCHIVE_PREFIX):])
+            if not os.path.isdir(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            with open(destination, 'wb') as output:
+                shutil.copyfileobj(archive.open(member), output)
+    os.remove(archive_path)
+    # Only complete builds are ever seen in the store
+    os.rename(partial, build_dir)
+    write_last_build(project_dir, build)
+
+
+def read_last_build(project_dir):
+    """Returns the build number last synced into the store, None if the
+    project was never synced"""
+    try:
+        with open(os.path.join(project_dir, 'last')) as last:
+            return int(last.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def write_last_build(project_dir, build):
+    path = os.path.join(project_dir, 'last')
+    with open(path + '.tmp', 'w') as last:
+        last.write('{}\n'.format(build))
+    os.rename(path + '.tmp', path)
+
+
+def copy_tree(source, target):
+    """Copies every file under source into target. The files are copied
+    rather than linked, later build steps write over them in place."""
+    for directory, _, files in os.walk(source):
+        relative = os.path.relpath(directory, source)
+        target_dir = os.path.normpath(os.path.join(target, relative))
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        for name in files:
+            shutil.copy2(os.path.join(directory, name),
+                         os.path.join(target_dir, name))
+
+
+def prune(project_dir, keep, build):
+    """Removes all but the newest keep builds of the project and the given
+    build, must be called holding the exclusive lock"""
+    builds = sorted(int(name) for name in os.listdir(project_dir)
+                    if name.isdigit())
+    for old in builds[:-keep]:
+        if old != build:
+            shutil.rmtree(os.path.join(project_dir, str(old)))
+
+
+def sync(jenkins, args, project):
+    start = time.time()
+    project_dir = os.path.join(args.store, project)
+    if not os.path.isdir(project_dir):
+        try:
+            os.makedirs(project_dir)
+        except OSError:
+            # Made by another job meanwhile
+            pass
+    previous = read_last_build(project_dir)
+    build = jenkins.last_successful_build(project)
+    if build is None:
+        return SyncResult(project, error='no successful build')
+
+    build_dir = os.path.join(project_dir, str(build))
+    downloaded = False
+    # Another job may prune the build between downloading and copying it
+    for _ in range(SYNC_ATTEMPTS):
+        with locked(project_dir, fcntl.LOCK_SH):
+            if os.path.isdir(build_dir):
+                copy_tree(build_dir, args.target)
+                return SyncResult(project, build, previous, downloaded,
+                                  time.time() - start)
+        with locked(project_dir, fcntl.LOCK_EX):
+            # Another job may have downloaded it while this one waited
+            if not os.path.isdir(build_dir):
+                download(jenkins, project_dir, project, build)
+                downloaded = True
+                prune(project_dir, args.keep, build)
+    return SyncResult(project, build, previous, downloaded,
+                      error='build #{} was removed from the store'.format(
+                          build))
+
+
+def sync_all(jenkins, args):
+    """Syncs every project using up to args.workers threads, returns the
+    results in the order of the projects"""
+    def sync_project(project):
+        try:
+            return sync(jenkins, args, project)
+        except Exception as e:
+            return SyncResult(project, error=str(e))
+
+    pool = ThreadPool(min(args.workers, len(args.projects)))
+    try:
+        return pool.map(sync_project, args.projects, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main():
+    args = parse_args()
+    if not args.jenkins_url:
+        print('No Jenkins URL, set JENKINS_URL or --jenkins-url',
+              file=sys.stderr)
+        return 1
+
+    start = time.time()
+    results = sync_all(Jenkins(args.jenkins_url), args)
+    failed = False
+    for result in results:
+        if result.error:
+            failed = True
+            print('{:<40} FAILED {}'.format(result.project, result.error),
+                  file=sys.stderr)
+        else:
+            if not result.downloaded:
+                status = 'cached'
+            elif result.previous is None:
+                status = 'downloaded'
+            else:
+                status = 'downloaded, was #{}'.format(result.previous)
+            print('{:<40} #{:<6} {:>6.1f}s {}'.format(
+                  result.project, result.build, result.elapsed, status))
+    print('Synced {} projects, downloaded {}, in {:.1f}s'.format(
+          len(results), sum(1 for result in results if result.downloaded),
+          time.time() - start))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
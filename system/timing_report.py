@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+#
+"""timing_report
+    Compares the task timing of a provisioning run with earlier builds.
+
+    Reads the JSON report written by callback_plugins/profile_tasks.py and
+    the reports of earlier builds kept in a history directory. Prints the
+    critical path through the run, the tasks and roles which took longer
+    than usual and a short trend of the last builds. The report is then
+    added to the history.
+
+    Tasks run one after another with the hosts running each task in
+    parallel, so the critical path is the slowest host of every task.
+
+    A task or role has regressed when it took more than --threshold
+    standard deviations longer than its mean over the history, and at
+    least --min-seconds longer, with at least --min-builds to compare with.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('report', help='profile_tasks JSON report')
+    parser.add_argument('--history', required=True,
+                        help='directory of the reports from earlier builds')
+    parser.add_argument('--build', default=None,
+                        help='build number to save the report as')
+    parser.add_argument('--keep', type=int, default=30,
+                        help='number of builds to keep in the history')
+    parser.add_argument('--threshold', type=float, default=3.0,
+                        help='standard deviations above the mean that are '
+                             'a regression')
+    parser.add_argument('--min-seconds', type=float, default=10.0,
+                        help='ignore regressions smaller than this')
+    parser.add_argument('--min-builds', type=int, default=5,
+                        help='builds needed before looking for regressions')
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of critical path tasks to show')
+    parser.add_argument('--trend', type=int, default=8,
+                        help='number of builds to show in the trend')
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help='exit with 1 when anything regressed')
+    return parser.parse_args()
+
+
+def load_report(path):
+    with open(path) as report_file:
+        return json.load(report_file)
+
+
+def history_files(history_dir):
+    """Returns the reports in the history, oldest first"""
+    if not os.path.isdir(history_dir):
+        return []
+    names = [name for name in os.listdir(history_dir)
+             if name.endswith('.json')]
+    paths = [os.path.join(history_dir, name) for name in names]
+    return sorted(paths, key=os.path.getmtime)
+
+
+def task_key(task, seen):
+    """Identifies a task across builds, a task name repeated within the
+    same play and role is numbered"""
+    key = (task.get('play') or '', task.get('role') or '', task['name'])
+    seen[key] = seen.get(key, 0) + 1
+    if seen[key] > 1:
+        key = key[:2] + ('{} #{}'.format(key[2], seen[key]),)
+    return key
+
+
+def format_key(key):
+    play, role, name = key
+    name = '{} | {}'.format(role, name) if role else name
+    return '{}: {}'.format(play, name) if play else name
+
+
+def critical_path(report):
+    """Returns [(key, host, seconds)] for each task, the host being the one
+    which finished last"""
+    path = []
+    seen = {}
+    for task in report['tasks']:
+        key = task_key(task, seen)
+        host, seconds = None, task.get('duration', 0)
+        for name, result in task.get('hosts', {}).items():
+            if host is None or result['duration'] > seconds:
+                host, seconds = name, result['duration']
+        path.append((key, host, seconds))
+    return path
+
+
+def durations(report):
+    """Returns {('task', key): seconds} and {('role', role): seconds} in one
+    dictionary, the time on the critical path"""
+    values = {}
+    for key, _, seconds in critical_path(report):
+        values[('task', key)] = seconds
+        if key[1]:
+            values[('role', key[1])] = values.get(('role', key[1]), 0) + \
+                seconds
+    return values
+
+
+def mean_and_deviation(values):
+    mean = sum(values) / len(values)
+    variance = sum((value - mean) ** 2 for value in values) / len(values)
+    return mean, math.sqrt(variance)
+
+
+def find_regressions(current, history, args):
+    """Returns [(kind, key, seconds, mean, deviation)] for everything which
+    regressed, biggest increase first"""
+    regressions = []
+    for item, seconds in current.items():
+        earlier = [values[item] for values in history if item in values]
+        if len(earlier) < args.min_builds:
+            continue
+        mean, deviation = mean_and_deviation(earlier)
+        if seconds - mean < args.min_seconds:
+            continue
+        if seconds > mean + args.threshold * deviation:
+            regressions.append((item[0], item[1], seconds, mean, deviation))
+    return sorted(regressions, key=lambda entry: entry[3] - entry[2])
+
+
+def print_critical_path(report, top):
+    path = critical_path(report)
+    total = sum(seconds for _, _, seconds in path)
+    print('Critical path {:.0f}s of {:.0f}s run'.format(
+          total, report['duration']))
+    for key, host, seconds in sorted(path, key=lambda entry: entry[2],
+                                     reverse=True)[:top]:
+        print('\t{:>7.1f}s {:>5.1f}% {:<12} {}'.format(
+              seconds, 100 * seconds / total if total else 0, host or '-',
+              format_key(key)))
+
+
+def print_regressions(regressions, args):
+    if not regressions:
+        print('No regressions')
+        return
+    print('Regressions, more than {} deviations over the mean:'.format(
+          args.threshold))
+    for kind, key, seconds, mean, deviation in regressions:
+        name = key if kind == 'role' else format_key(key)
+        print('\t{:<4} {:>7.1f}s mean {:>7.1f}s +/- {:<6.1f} {}'.format(
+              kind, seconds, mean, deviation, name))
+
+
+def print_trend(reports, labels):
+    """Prints the run time, critical path and time of each role for the
+    given builds, oldest first"""
+    values = [durations(report) for report in reports]
+    roles = sorted(set(item[1] for value in values for item in value
+                       if item[0] == 'role'))
+    rows = [('run', [report['duration'] for report in reports]),
+            ('critical path', [sum(seconds for _, _, seconds in
+                                   critical_path(report))
+                               for report in reports])]
+    rows.extend((role, [value.get(('role', role)) for value in values])
+                for role in roles)
+
+    print('Trend:')
+    print('\t{:<24}'.format('') +
+          ''.join('{:>8}'.format(label[-8:]) for label in labels))
+    for name, seconds in rows:
+        print('\t{:<24}'.format(name[:24]) +
+              ''.join('{:>8}'.format('-' if value is None else
+                                     '{:.0f}'.format(value))
+                      for value in seconds))
+
+
+def save_report(report_path, history_dir, build, keep):
+    if not os.path.isdir(history_dir):
+        os.makedirs(history_dir)
+    name = '{}.json'.format(build) if build else \
+        os.path.basename(report_path)
+    # Copy then rename so concurrent readers never see half a report
+    destination = os.path.join(history_dir, name)
+    shutil.copy(report_path, destination + '.tmp')
+    os.rename(destination + '.tmp', destination)
+    for path in history_files(history_dir)[:-keep]:
+        os.remove(path)
+
+
+def main():
+    args = parse_args()
+    report = load_report(args.report)
+    paths = []
+    history = []
+    for path in history_files(args.history):
+        try:
+            history.append(load_report(path))
+            paths.append(path)
+        except ValueError:
+            print('Ignoring unreadable report {}'.format(path),
+                  file=sys.stderr)
+
+    print_critical_path(report, args.top)
+    regressions = find_regressions(durations(report),
+                                   [durations(earlier) for earlier in history],
+                                   args)
+    print_regressions(regressions, args)
+
+    labels = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    first = max(len(history) - args.trend + 1, 0)
+    print_trend(history[first:] + [report],
+                labels[first:] + [args.build or 'this'])
+
+    save_report(args.report, args.history, args.build, args.keep)
+    if regressions and args.fail_on_regression:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,66 @@
 #!/bin/bash
 # Uncompress the tarball artifacts for ansible roles stripping the ansible- in the role name
 # This works in conjunction with the jjb macro uncompress-roles which in turn works with artifact copying from Ansible lint jobs
+#
+# The workspace is wiped for every build so each tarball is extracted into a cache directory named after its checksum
+# and the role is linked to it. A tarball that hasn't changed since it was last extracted is not extracted again and
+# cached roles unused for a week are removed.
+# Tarballs are extracted concurrently and the time taken for each role is written to reports/role-timing.csv
 base_dir=$PWD
 target_dir=$1
+cache_dir=${ROLE_CACHE_DIR:-/var/tmp/monasca-ci/roles}
+timing_file=$base_dir/reports/role-timing.csv
+timing_dir=$(mktemp -d)
+trap "rm -rf $timing_dir" EXIT
+
+# Links the role to its extracted tarball, extracting it first when it isn't cached
+# The tarball is extracted to a temporary directory that is then renamed so a cached role is always complete
+uncompress_role() {
+  local file=$1
+  local full_name=`basename $file`
+  local file_name=${full_name%.tar.gz}
+  local role_name=${file_name#ansible-}
+  local start=$(date +%s.%N)
+  local checksum=`sha1sum $file | cut -d' ' -f1`
+  local cached=$cache_dir/$role_name/$checksum
+  local status=cached
+  if [ ! -d $cached ]; then
+    status=extracted
+    mkdir -p $cache_dir/$role_name
+    local extract_dir=`mktemp -d $cache_dir/$role_name/.$checksum.XXXXXX`
+    if ! tar -xzf $base_dir/$file -C $extract_dir; then
+      rm -rf $extract_dir
+      echo "Failed to extract $file" >&2
+      return 1
+    fi
+    chmod 755 $extract_dir
+    # Another build may have extracted the same tarball meanwhile
+    mv -T $extract_dir $cached 2> /dev/null || rm -rf $extract_dir
+  fi
+  # Marks the cached role as used so it isn't pruned
+  touch $cached
+  rm -rf $target_dir/$role_name
+  ln -s $cached $target_dir/$role_name
+  echo "$role_name,$status,$(awk "BEGIN {printf \"%.3f\", $(date +%s.%N) - $start}")" > $timing_dir/$role_name
+}
+
+mkdir -p $target_dir
+pids=()
 for file in `ls artifacts/tars/*.tar.gz`; do
-  full_name=`basename $file`
-  file_name=${full_name%.tar.gz}
-  role_name=${file_name#ansible-}
-  mkdir -p $target_dir/$role_name
-  cd $target_dir/$role_name
-  tar -xzf $base_dir/$file
-  cd $base_dir
+  uncompress_role $file &
+  pids+=($!)
 done
+
+failed=0
+for pid in "${pids[@]}"; do
+  wait $pid || failed=1
+done
+
+# Roles unused for a week are removed from the cache
+find $cache_dir -mindepth 2 -maxdepth 2 -type d -mtime +7 -exec rm -rf {} + 2> /dev/null
+
+mkdir -p `dirname $timing_file`
+echo "role,status,seconds" > $timing_file
+cat $timing_dir/* >> $timing_file 2> /dev/null
+cat $timing_file
+exit $failed
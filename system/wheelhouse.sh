@@ -0,0 +1,70 @@
+#!/bin/bash
+# Installs the Monasca python artifacts with one pip run from a wheelhouse shared by all the containers on the host.
+# The wheelhouse holds wheels of the artifacts' dependencies and is keyed by a hash of their requirements, so C
+# extensions like MySQLdb are only compiled when the requirements change. Installing from it needs no index.
+# Wheelhouses unused for WHEELHOUSE_DAYS are removed.
+#
+# Usage: wheelhouse.sh <virtualenv dir> <artifact name>...
+# The artifacts are <virtualenv dir>/dist/<artifact name>*, /var/pip-cache is /var/tmp on the docker host.
+
+VENV=$1
+shift
+WHEELHOUSES=${WHEELHOUSES:-/var/pip-cache/wheelhouse}
+WHEELHOUSE_DAYS=${WHEELHOUSE_DAYS:-7}
+
+artifacts=()
+for name in "$@"; do
+    artifacts+=($VENV/dist/${name}*)
+done
+
+# Wheels are keyed by their Requires-Dist, anything else by its content as its requirements can't be read
+key=$($VENV/bin/python - "${artifacts[@]}" <<'PYTHON'
+import hashlib
+import platform
+import sys
+import zipfile
+
+key = hashlib.sha1(platform.python_version() + platform.machine())
+requirements = set()
+for path in sys.argv[1:]:
+    if not path.endswith('.whl'):
+        requirements.add(hashlib.sha1(open(path, 'rb').read()).hexdigest())
+        continue
+    archive = zipfile.ZipFile(path)
+    for name in archive.namelist():
+        if name.endswith('.dist-info/METADATA'):
+            for line in archive.read(name).splitlines():
+                if line.startswith('Requires-Dist:'):
+                    requirements.add(line.split(':', 1)[1].strip())
+key.update('\n'.join(sorted(requirements)))
+print(key.hexdigest()[:16])
+PYTHON
+) || exit 1
+wheelhouse=$WHEELHOUSES/$key
+mkdir -p $WHEELHOUSES
+
+# The first container to get the lock builds the wheelhouse, the others wait and use it. It is built in a temporary
+# directory and moved into place so it is either complete or missing.
+# One lock covers every wheelhouse so pruning never removes one that another container has just picked.
+(
+    flock 9
+    if [ ! -d $wheelhouse ]; then
+        echo "Building wheelhouse $key"
+        build=$(mktemp -d $WHEELHOUSES/.$key.XXXXXX)
+        if ! $VENV/bin/pip install wheel || ! $VENV/bin/pip wheel --wheel-dir=$build "${artifacts[@]}"; then
+            rm -rf $build
+            exit 1
+        fi
+        # The artifacts change with every build, only their dependencies are kept
+        for artifact in "${artifacts[@]}"; do
+            rm -f $build/$(basename $artifact)
+        done
+        mv $build $wheelhouse
+    fi
+    # Marks the wheelhouse as used so it isn't pruned
+    touch $wheelhouse
+    find $WHEELHOUSES -mindepth 1 -maxdepth 1 ! -name .lock -mtime +$WHEELHOUSE_DAYS -exec rm -rf {} +
+) 9> $WHEELHOUSES/.lock || exit 1
+
+echo "Installing from wheelhouse $key"
+$VENV/bin/pip install --no-index --find-links=$wheelhouse "${artifacts[@]}"
@@ -12,19 +12,31 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import argparse
 import datetime
 import json
+import os
 import random
 import requests
 import sys
+import threading
 import time
 import urllib
 import yaml
 
-from jsonschema import validate
+from jsonschema import Draft4Validator
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from monascaclient import ksclient
 
+# The smoke test helpers are in tests/smoke and are copied next to this file
+# on the test box
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'smoke'))
+import paging
+from stats import percentile
+
 timestamp_pattern = ("[0-9]{2}-[0-9]{2}-[0-9]{2}T" +
                      "[0-9]{2}:[0-9]{2}:[0-9]{2}(.[0-9]{0,3})?Z")
 
@@ -284,14 +296,66 @@ alarm_schema = {
 }
 
 
+class SchemaRegistry(object):
+    """Compiles each schema into a validator once and reuses it.
+
+    Validators are looked up by schema identity so only long lived schemas,
+    like the module level ones above, should be used.
+    """
+
+    def __init__(self):
+        self.validators = {}
+        self.lock = threading.Lock()
+
+    def validator(self, schema):
+        entry = self.validators.get(id(schema))
+        if entry is None or entry[0] is not schema:
+            Draft4Validator.check_schema(schema)
+            with self.lock:
+                entry = (schema, Draft4Validator(schema))
+                self.validators[id(schema)] = entry
+        return entry[1]
+
+    def validate(self, json_data, schema):
+        """Raises the first ValidationError found, if any"""
+        for error in self.validator(schema).iter_errors(json_data):
+            raise error
+
+    def validate_list(self, json_data, item_schema):
+        """Validates a list response and each of its elements.
+
+        The envelope and the elements are checked with separate validators
+        so no list-of-item schema has to be built, and checking stops at the
+        first bad element.
+        """
+        self.validate(json_data, list_schema)
+        validator = self.validator(item_schema)
+        for index, element in enumerate(json_data['elements']):
+            for error in validator.iter_errors(element):
+                error.path.appendleft(index)
+                error.path.appendleft('elements')
+                raise error
+
+
+schemas = SchemaRegistry()
+
+
 class APIConnection(object):
-    def __init__(self, api_url, keystone_config):
+    """A keep-alive session with the API.
+
+    Requests that fail to connect are retried with backoff and a request
+    rejected with 401 is sent once more after getting a new Keystone token.
+    """
+
+    def __init__(self, api_url, keystone_config, pool_size=10):
         self.url = api_url
         if api_url[-1] == '/':
             self.base_url, self.version = api_url[:-1].rsplit('/', 1)
         else:
             self.base_url, self.version = api_url.rsplit('/', 1)
 
+        self.keystone_config = keystone_config
+        self.auth_lock = threading.Lock()
         self.ks = ksclient.KSClient(**keystone_config)
         self.headers = {'X-Auth-User': keystone_config['username'],
                         'X-Auth-Token': self.ks.token,
@@ -300,11 +364,38 @@ class APIConnection(object):
                         'User-Agent': 'python-monascaclient',
                         'Content-Type': 'application/json'}
 
+        # Only connection failures are retried, the request was never
+        # received so it is safe for any method
+        retries = Retry(total=3, connect=3, read=0, backoff_factor=0.5)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retries)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
     def do_request(self, method, rel_url='', body=None):
-        return requests.request(method=method,
-                                url=self.url+rel_url,
-                                data=json.dumps(body),
-                                headers=self.headers)
+        data = json.dumps(body) if body is not None else None
+        return self.request(method, self.url+rel_url, data)
+
+    def request(self, method, url, data=None):
+        headers = self.headers
+        response = self.session.request(method=method, url=url, data=data,
+                                        headers=headers)
+        if response.status_code == 401:
+            self.reauthenticate(headers['X-Auth-Token'])
+            response = self.session.request(method=method, url=url,
+                                            data=data, headers=self.headers)
+        return response
+
+    def reauthenticate(self, expired_token):
+        with self.auth_lock:
+            # Another thread may already have replaced the token
+            if self.headers['X-Auth-Token'] != expired_token:
+                return
+            self.ks = ksclient.KSClient(**self.keystone_config)
+            headers = dict(self.headers)
+            headers['X-Auth-Token'] = self.ks.token
+            self.headers = headers
 
 
 def verify_response_code(res, expected):
@@ -314,17 +405,61 @@ def verify_response_code(res, expected):
                                                        res.text)
 
 
+def validate(json_data, schema):
+    schemas.validate(json_data, schema)
+
+
+def validate_list(json_data, item_schema):
+    schemas.validate_list(json_data, item_schema)
+
+
+def next_link(json_data):
+    for link in json_data.get('links', []):
+        if link.get('rel') == 'next':
+            return link['href']
+    return None
+
+
+def iterate_list(api, rel_url, item_schema, limit=None):
+    """Yields the elements of a list, following the next links.
+
+    Each page is validated before its elements are yielded.
+    """
+    def get_page(url):
+        response = api.request("GET", url)
+        verify_response_code(response, 200)
+        json_data = json.loads(response.text)
+        validate_list(json_data, item_schema)
+        return json_data['elements'], next_link(json_data)
+
+    url = api.url + rel_url
+    if limit is not None:
+        url += ('&' if '?' in url else '?') + 'limit={}'.format(limit)
+    return paging.iterate_pages(get_page, url)
+
+
+def depends_on(*names):
+    """Marks a test to run only after the named tests have passed"""
+    def decorator(test):
+        test.depends_on = names
+        return test
+    return decorator
+
+
+def runs_alone(test):
+    """Marks a test to run with no other test running at the same time"""
+    test.runs_alone = True
+    return test
+
+
 # test version info
 def test_version_list(api):
-    response = requests.request(method="GET",
-                                url=api.base_url,
-                                headers=api.headers)
+    response = api.request("GET", api.base_url)
 
     verify_response_code(response, 200)
     json_data = json.loads(response.text)
 
-    list_schema['properties']['elements']['items'] = version_schema
-    validate(json_data, list_schema)
+    validate_list(json_data, version_schema)
     version_list = []
     for element in json_data['elements']:
         version_list.append(element['id'])
@@ -410,8 +545,7 @@ def test_metric_list(api):
     verify_response_code(response, 200)
 
     json_data = json.loads(response.text)
-    list_schema['properties']['elements']['items'] = metric_schema
-    validate(json_data, list_schema)
+    validate_list(json_data, metric_schema)
 
 
 def test_metric_name_list(api):
@@ -420,10 +554,11 @@ def test_metric_name_list(api):
     verify_response_code(response, 200)
 
     json_data = json.loads(response.text)
-    list_schema['properties']['elements']['items'] = metric_name_schema
-    validate(json_data, list_schema)
+    validate_list(json_data, metric_name_schema)
 
 
+@depends_on('test_metric_post', 'test_metric_post_array',
+            'test_metric_post_value_meta')
 def test_measurement_list(api):
     one_hour_ago = datetime.datetime.utcnow()-datetime.timedelta(hours=1)
     one_hour_ago = one_hour_ago - datetime.timedelta(microseconds=
@@ -440,10 +575,11 @@ def test_measurement_list(api):
     verify_response_code(response, 200)
 
     json_data = json.loads(response.text)
-    list_schema['properties']['elements']['items'] = measurement_schema
-    validate(json_data, list_schema)
+    validate_list(json_data, measurement_schema)
 
 
+@depends_on('test_metric_post', 'test_metric_post_array',
+            'test_metric_post_value_meta')
 def test_statistics_get(api):
     one_hour_ago = datetime.datetime.utcnow()-datetime.timedelta(minutes=1)
     one_hour_ago = one_hour_ago - datetime.timedelta(microseconds=
@@ -461,8 +597,7 @@ def test_statistics_get(api):
     verify_response_code(response, 200)
 
     json_data = json.loads(response.text)
-    list_schema['properties']['elements']['items'] = statistics_schema
-    validate(json_data, list_schema)
+    validate_list(json_data, statistics_schema)
 
 
 def test_notification_CRUD(api):
@@ -492,8 +627,7 @@ def test_notification_CRUD(api):
     verify_response_code(response, 200)
 
     json_data = json.loads(response.text)
-    list_schema['properties']['elements']['items'] = notification_schema
-    validate(json_data, list_schema)
+    validate_list(json_data, notification_schema)
 
     response = api.do_request("GET", "/notification-methods/"+notification_id)
 
@@ -551,8 +685,7 @@ def test_alarm_definition_CRUD(api):
     verify_response_code(response, 200)
     json_data = json.loads(response.text)
 
-    list_schema['properties']['elements']['items'] = alarm_definition_schema
-    validate(json_data, list_schema)
+    validate_list(json_data, alarm_definition_schema)
 
     # list
     response = api.do_request("GET", "/alarm-definitions/"+definition_id)
@@ -601,20 +734,17 @@ def test_alarm_state_history_list(api):
     verify_response_code(response, 200)
 
     json_data = json.loads(response.text)
-    list_schema['properties']['elements']['items'] = alarm_history_schema
-    validate(json_data, list_schema)
+    validate_list(json_data, alarm_history_schema)
 
 
+# Changes and deletes whichever alarm is listed first, which may belong to
+# a definition another test is changing
+@runs_alone
 def test_alarm_list_get_update_delete(api):
-    # alarm list
-    response = api.do_request("GET", "/alarms")
-
-    verify_response_code(response, 200)
-    json_data = json.loads(response.text)
-
-    list_schema['properties']['elements']['items'] = alarm_schema
-    validate(json_data, list_schema)
-    alarm_id = json_data['elements'][0]['id']
+    # alarm list, only the first alarm is needed
+    alarm = next(iterate_list(api, "/alarms", alarm_schema, limit=10), None)
+    assert alarm is not None, "No alarms found"
+    alarm_id = alarm['id']
 
     # alarm update
     body = {
@@ -667,38 +797,403 @@ def test_alarm_list_get_update_delete(api):
     verify_response_code(response, 404)
 
 
+class TestResult(object):
+    def __init__(self, name, status, elapsed=0.0, message=''):
+        self.name = name
+        self.status = status
+        self.elapsed = elapsed
+        self.message = message
+
+
+def discover_tests():
+    """Returns the test_* functions of this module in source order"""
+    tests = [value for name, value in globals().items()
+             if name.startswith('test_') and callable(value)]
+    return sorted(tests, key=lambda test: test.func_code.co_firstlineno)
+
+
+def run_tests(api, tests, workers, timeout):
+    """Runs the tests on up to workers threads, a test starts once all the
+    tests it depends on have passed and is skipped if any of them failed.
+    Tests still running after timeout seconds fail and those not started
+    are skipped. Returns a TestResult for each test in the order given."""
+    results = {}
+    waiting = list(tests)
+    names = set(test.__name__ for test in tests)
+    condition = threading.Condition()
+    running = []
+    deadline = time.time() + timeout
+
+    def next_test():
+        """Takes the next runnable test, must hold the condition"""
+        if any(getattr(test, 'runs_alone', False) for test in running):
+            return None
+        for test in waiting:
+            # Dependencies that were not selected to run are ignored
+            depends = [name for name in getattr(test, 'depends_on', ())
+                       if name in names]
+            failed = [name for name in depends
+                      if name in results and results[name].status != 'PASS']
+            if failed:
+                waiting.remove(test)
+                results[test.__name__] = TestResult(
+                    test.__name__, 'SKIP',
+                    message='depends on failed {}'.format(', '.join(failed)))
+                condition.notify_all()
+                return next_test()
+            if all(name in results for name in depends):
+                # Nothing else starts until the running tests finish
+                if getattr(test, 'runs_alone', False) and running:
+                    return None
+                waiting.remove(test)
+                running.append(test)
+                return test
+        return None
+
+    def worker():
+        while True:
+            with condition:
+                test = next_test()
+                while test is None and waiting and time.time() < deadline:
+                    # Waits in steps so the deadline is noticed
+                    condition.wait(1)
+                    test = next_test()
+                if test is None:
+                    return
+            start = time.time()
+            try:
+                test(api)
+                result = TestResult(test.__name__, 'PASS')
+            except Exception as e:
+                result = TestResult(test.__name__, 'FAIL',
+                                    message='{}: {}'.format(
+                                        type(e).__name__, e))
+            result.elapsed = time.time() - start
+            with condition:
+                running.remove(test)
+                results[test.__name__] = result
+                condition.notify_all()
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Joined in steps, a join without a timeout ignores Ctrl-C in
+        # Python 2
+        while thread.is_alive() and time.time() < deadline:
+            thread.join(1)
+
+    with condition:
+        for test in running:
+            results[test.__name__] = TestResult(
+                test.__name__, 'FAIL', timeout,
+                'still running after {}s'.format(timeout))
+        for test in tests:
+            if test.__name__ not in results:
+                results[test.__name__] = TestResult(
+                    test.__name__, 'SKIP',
+                    message='not started within {}s'.format(timeout))
+        return [results[test.__name__] for test in tests]
+
+
+def print_results(results, elapsed):
+    for result in results:
+        print("{:<40} {:<4} {:>7.2f}s {}".format(result.name, result.status,
+                                                 result.elapsed,
+                                                 result.message))
+    failed = len([result for result in results if result.status != 'PASS'])
+    print("{} tests, {} passed, {} failed or skipped in {:.2f}s".format(
+          len(results), len(results) - failed, failed, elapsed))
+
+
+class MetricLoad(object):
+    """Posts batches of synthetic metrics at a fixed rate.
+
+    Every name and dimension combination is serialized once up front so
+    building a batch only joins strings with a new timestamp and value.
+    """
+
+    def __init__(self, api, rate, concurrency, duration, batch_size,
+                 names, dimension_values):
+        self.api = api
+        self.rate = rate
+        self.concurrency = concurrency
+        self.duration = duration
+        self.batch_size = batch_size
+        self.templates = self.build_templates(names, dimension_values)
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.latencies = []
+        self.errors = {}
+
+    @staticmethod
+    def build_templates(names, dimension_values):
+        run_id = str(random.randint(1, 1000000))
+        templates = []
+        for name in range(names):
+            for value in range(dimension_values):
+                metric = json.dumps({
+                    "name": "load_test.metric_{}".format(name),
+                    "dimensions": {"load_test_run": run_id,
+                                   "load_test_dim": "value_{}".format(value)}
+                })
+                # Leave the object open for the timestamp and value
+                templates.append(metric[:-1] + ', "timestamp": ')
+        return templates
+
+    def build_batch(self, offset):
+        timestamp = str(int(time.time() * 1000))
+        metrics = []
+        for index in range(offset, offset + self.batch_size):
+            template = self.templates[index % len(self.templates)]
+            metrics.append(template + timestamp + ', "value": ' +
+                           str(index) + '}')
+        return '[' + ', '.join(metrics) + ']'
+
+    def next_batch(self):
+        """Returns the number of the next batch to send or None when the
+        duration is over"""
+        with self.lock:
+            number = self.batches
+            self.batches += 1
+        if number >= self.rate * self.duration:
+            return None
+        return number
+
+    def worker(self, start):
+        url = self.api.url + "/metrics"
+        while True:
+            number = self.next_batch()
+            if number is None:
+                return
+            delay = start + number / float(self.rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            body = self.build_batch(number * self.batch_size)
+            sent = time.time()
+            try:
+                status = self.api.request("POST", url, body).status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            latency = time.time() - sent
+            with self.lock:
+                if status == 204:
+                    self.latencies.append(latency)
+                else:
+                    self.errors[status] = self.errors.get(status, 0) + 1
+
+    def run(self):
+        start = time.time()
+        threads = [threading.Thread(target=self.worker, args=(start,))
+                   for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+    def print_report(self, elapsed):
+        sent = len(self.latencies)
+        error_count = sum(self.errors.values())
+        print("Posted {} batches of {} metrics in {:.2f}s, {:.1f} metrics/s"
+              .format(sent, self.batch_size, elapsed,
+                      sent * self.batch_size / elapsed))
+        latencies = sorted(self.latencies)
+        if latencies:
+            print("Latency ms p50 {:.1f} p90 {:.1f} p99 {:.1f} max {:.1f}"
+                  .format(percentile(latencies, 0.5) * 1000,
+                          percentile(latencies, 0.9) * 1000,
+                          percentile(latencies, 0.99) * 1000,
+                          latencies[-1] * 1000))
+        print("Errors {}".format(error_count))
+        for status, count in sorted(self.errors.items()):
+            print("\t{}: {}".format(status, count))
+        return error_count
+
+
+class IngestProbe(object):
+    """Measures how long posted metrics take to become queryable.
+
+    Metrics are posted at a steady interval while the measurements of every
+    probe not seen yet are polled. Each metric has its own probe_id
+    dimension so it is a separate series and the time it first appears can
+    be recorded.
+    """
+    metric_name = 'monasca.ci.ingest_probe'
+
+    def __init__(self, api, count, interval, timeout, poll_interval=0.5):
+        self.api = api
+        self.count = count
+        self.interval = interval
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.run_id = str(random.randint(1, 1000000))
+        self.lock = threading.Lock()
+        self.posted = {}
+        self.seen = {}
+
+    def post(self):
+        for probe_id in range(self.count):
+            body = {
+                "name": self.metric_name,
+                "dimensions": {"probe_run": self.run_id,
+                               "probe_id": str(probe_id)},
+                "timestamp": time.time()*1000,
+                "value": probe_id
+            }
+            sent = time.time()
+            response = self.api.do_request("POST", "/metrics", body)
+            if response.status_code == 204:
+                with self.lock:
+                    self.posted[str(probe_id)] = sent
+            else:
+                print("Probe {} post failed with {}".format(
+                      probe_id, response.status_code))
+            time.sleep(self.interval)
+
+    def poll(self, probe_id, start_time):
+        """Records when the probe's series first has a measurement.
+
+        Each probe is queried on its own, the API rejects a query matching
+        several series unless they are merged, which would lose probe_id.
+        """
+        query_str = urllib.urlencode({
+            "name": self.metric_name,
+            "dimensions": "probe_run:{},probe_id:{}".format(self.run_id,
+                                                            probe_id),
+            "start_time": start_time,
+        })
+        response = self.api.do_request("GET",
+                                       "/metrics/measurements?"+query_str)
+        now = time.time()
+        verify_response_code(response, 200)
+        for element in json.loads(response.text)['elements']:
+            if element['measurements']:
+                self.seen[probe_id] = now
+                return
+
+    def run(self):
+        start = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+        start = start - datetime.timedelta(microseconds=start.microsecond)
+        start_time = start.isoformat()+'Z'
+
+        poster = threading.Thread(target=self.post)
+        poster.daemon = True
+        poster.start()
+        deadline = None
+        while True:
+            with self.lock:
+                waiting = set(self.posted) - set(self.seen)
+            for probe_id in sorted(waiting, key=int):
+                self.poll(probe_id, start_time)
+            if deadline is None and not poster.is_alive():
+                deadline = time.time() + self.timeout
+            with self.lock:
+                waiting = set(self.posted) - set(self.seen)
+            if deadline is not None and (not waiting or
+                                         time.time() > deadline):
+                return
+            time.sleep(self.poll_interval)
+
+    def print_report(self):
+        latencies = sorted(self.seen[probe_id] - sent
+                           for probe_id, sent in self.posted.items()
+                           if probe_id in self.seen)
+        missing = len(self.posted) - len(latencies)
+        print("Ingest latency for {} of {} probe metrics, polled every {}s"
+              .format(len(latencies), self.count, self.poll_interval))
+        if latencies:
+            print("Latency s p50 {:.2f} p90 {:.2f} p99 {:.2f} max {:.2f}"
+                  .format(percentile(latencies, 0.5),
+                          percentile(latencies, 0.9),
+                          percentile(latencies, 0.99),
+                          latencies[-1]))
+        print("Not queryable after {}s: {}".format(self.timeout, missing))
+        return missing + self.count - len(self.posted)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog=argv[0])
+    parser.add_argument('config', help='config yaml')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='number of tests to run at the same time')
+    parser.add_argument('-t', '--test', action='append', default=None,
+                        help='run only the named test, may be repeated')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds the tests may take in all')
+    load = parser.add_argument_group('load', 'post metrics at a fixed rate '
+                                     'instead of running the tests')
+    load.add_argument('--load', action='store_true', default=False,
+                      help='run in load generation mode')
+    load.add_argument('--rate', type=float, default=10,
+                      help='batches to post per second')
+    load.add_argument('--concurrency', type=int, default=4,
+                      help='number of batches in flight at once')
+    load.add_argument('--duration', type=float, default=60,
+                      help='seconds to post for')
+    load.add_argument('--batch-size', type=int, default=100,
+                      help='metrics per batch')
+    load.add_argument('--names', type=int, default=10,
+                      help='number of distinct metric names')
+    load.add_argument('--dimension-values', type=int, default=100,
+                      help='number of distinct dimension values per name')
+    ingest = parser.add_argument_group('ingest', 'measure the time from '
+                                       'posting a metric to it being '
+                                       'queryable instead of running the '
+                                       'tests')
+    ingest.add_argument('--ingest-probe', action='store_true', default=False,
+                        help='run the ingest latency probe')
+    ingest.add_argument('--probes', type=int, default=20,
+                        help='number of probe metrics to post')
+    ingest.add_argument('--probe-interval', type=float, default=1,
+                        help='seconds between probe metrics')
+    ingest.add_argument('--probe-timeout', type=float, default=120,
+                        help='seconds to wait for the last probe to be '
+                             'queryable')
+    return parser.parse_args(argv[1:])
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
-    if len(argv) != 2:
-        print "Usage: " + argv[0] + " <config yaml>"
-        return 1
+    args = parse_args(argv)
 
-    with open(argv[1], 'r') as config_yaml:
+    with open(args.config, 'r') as config_yaml:
         config = yaml.load(config_yaml.read())
 
-    api = APIConnection(config['monasca_api_url'], config['keystone'])
-
-    test_version_list(api)
-    test_version_get(api)
-
-    test_notification_CRUD(api)
-
-    test_metric_post(api)
-    test_metric_post_array(api)
-    test_metric_post_value_meta(api)
-    test_metric_list(api)
-    test_metric_name_list(api)
-    test_measurement_list(api)
-    test_statistics_get(api)
-
-    test_alarm_definition_CRUD(api)
-
-    test_alarm_state_history_list(api)
-    test_alarm_list_get_update_delete(api)
-
+    api = APIConnection(config['monasca_api_url'], config['keystone'],
+                        pool_size=max(args.workers, args.concurrency))
+
+    if args.load:
+        load = MetricLoad(api, args.rate, args.concurrency, args.duration,
+                          args.batch_size, args.names, args.dimension_values)
+        if load.print_report(load.run()):
+            return 1
+        return 0
+
+    if args.ingest_probe:
+        probe = IngestProbe(api, args.probes, args.probe_interval,
+                            args.probe_timeout)
+        probe.run()
+        if probe.print_report():
+            return 1
+        return 0
+
+    tests = discover_tests()
+    if args.test:
+        tests = [test for test in tests if test.__name__ in args.test]
+
+    start = time.time()
+    results = run_tests(api, tests, args.workers, args.timeout)
+    print_results(results, time.time() - start)
+
+    if any(result.status != 'PASS' for result in results):
+        return 1
     print("pass")
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+""" Listens to the alarm-state-transitions Kafka topic so the smoke test can
+    wait for an alarm to change state without polling the API.
+"""
+from __future__ import print_function
+import json
+import sys
+import threading
+import time
+
+TOPIC = 'alarm-state-transitions'
+
+
+class AlarmTransitionListener(object):
+    """Consumes alarm state transitions in a background thread.
+
+    Consumption starts at the end of the topic so only transitions that
+    happen after start() are seen. Transitions are kept per alarm in the
+    order they arrive.
+    """
+
+    def __init__(self, kafka_hosts, group='monasca_smoke_test'):
+        self.kafka_hosts = kafka_hosts
+        self.group = group
+        self.transitions = {}
+        self.consumed = {}
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        import kafka
+        client = kafka.client.KafkaClient(self.kafka_hosts)
+        self.consumer = kafka.consumer.SimpleConsumer(client, self.group,
+                                                      TOPIC,
+                                                      auto_commit=False,
+                                                      max_buffer_size=None)
+        # Skip everything already on the topic
+        self.consumer.seek(0, 2)
+        self.running = True
+        self.thread = threading.Thread(target=self._consume)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(5)
+
+    def _consume(self):
+        while self.running:
+            try:
+                messages = self.consumer.get_messages(count=100, block=True,
+                                                      timeout=1)
+            except Exception as e:
+                print('Error reading {}: {}'.format(TOPIC, e),
+                      file=sys.stderr)
+                time.sleep(1)
+                continue
+            for message in messages:
+                self._record(message.message.value)
+
+    def _record(self, value):
+        try:
+            transition = json.loads(value)['alarm-transitioned']
+        except (ValueError, KeyError, TypeError):
+            return
+        with self.condition:
+            self.transitions.setdefault(transition['alarmId'], []).append(
+                (transition['oldState'], transition['newState'], time.time()))
+            self.condition.notify_all()
+
+    def _next_transition(self, alarm_id, old_state):
+        """Returns the new state of the first unconsumed transition out of
+        old_state, must be called with the condition held"""
+        transitions = self.transitions.get(alarm_id, [])
+        for index in range(self.consumed.get(alarm_id, 0), len(transitions)):
+            if transitions[index][0] == old_state:
+                self.consumed[alarm_id] = index + 1
+                return transitions[index][1]
+        return None
+
+    def transition_time(self, alarm_id, new_state):
+        """Returns when the first transition of the alarm into new_state
+        was received or None if there was none"""
+        with self.condition:
+            for transition in self.transitions.get(alarm_id, []):
+                if transition[1] == new_state:
+                    return transition[2]
+        return None
+
+    def wait_for_transition(self, alarm_id, old_state, timeout):
+        """Waits for the alarm to transition out of old_state, returns the new
+        state or None if no transition arrived within timeout seconds"""
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                state = self._next_transition(alarm_id, old_state)
+                if state is not None:
+                    return state
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+
+def start_listener(kafka_hosts):
+    """Returns a started listener or None if Kafka can not be reached"""
+    if not kafka_hosts:
+        return None
+    listener = AlarmTransitionListener(kafka_hosts)
+    try:
+        listener.start()
+    except Exception as e:
+        print('Unable to listen to {} on {}, polling the API instead: {}'
+              .format(TOPIC, kafka_hosts, e), file=sys.stderr)
+        return None
+    print('Listening for alarm state transitions on {}'.format(kafka_hosts))
+    return listener
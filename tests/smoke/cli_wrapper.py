@@ -1,12 +1,247 @@
 #!/usr/bin/env python
 #
-""" Wrapper code for running the CLI as a process.
+""" Wrapper code for talking to the Monasca API.
+
+    Two backends are available. The 'process' backend runs the CLI as a
+    process for every call, the 'client' backend uses monascaclient in
+    process and reuses a single Keystone token for the whole run. The
+    backend is chosen with set_backend() or the MONASCA_CLI_BACKEND
+    environment variable and defaults to 'client', falling back to
+    'process' when monascaclient can not be used.
+
+    Every request is recorded as a timing span, an 'http' span named after
+    the request with the client backend and a 'subprocess' span named after
+    the CLI command with the process backend.
+
+    The iterate_* functions return lists lazily. The client backend pages
+    through them following the API's next links and fetches the next page
+    while the current one is consumed.
 """
 from __future__ import print_function
+import itertools
 import sys
 import subprocess
 import json
 import os
+import re
+import time
+import urllib
+import urlparse
+import paging
+import timing
+
+MONASCA_CLI = '/opt/monasca/bin/monasca'
+DEFAULT_BACKEND = 'client'
+PAGE_SIZE = 100
+# Ids in request paths are replaced so each kind of request has one name
+ID_PATTERN = re.compile(r'/[0-9a-fA-F-]{32,}')
+
+_backend = None
+
+
+class ProcessBackend(object):
+    """Runs the monasca CLI as a process for each call"""
+    name = 'process'
+
+    def list_alarm_definitions(self):
+        return run_mon_cli(['alarm-definition-list'])
+
+    def delete_alarm_definition(self, alarm_definition_id):
+        run_mon_cli(['alarm-definition-delete', alarm_definition_id],
+                    useJson=False)
+
+    def create_alarm_definition(self, name, expression, description=None,
+                                ok_notif_id=None, alarm_notif_id=None,
+                                undetermined_notif_id=None, match_by=None):
+        args = ['alarm-definition-create']
+        add_argument_if_given(args, '--description', description)
+        if match_by:
+            add_argument_if_given(args, '--match-by', ','.join(match_by))
+        add_argument_if_given(args, '--alarm-actions', alarm_notif_id)
+        add_argument_if_given(args, '--ok-actions', ok_notif_id)
+        add_argument_if_given(args, '--undetermined-actions',
+                              undetermined_notif_id)
+        args.append(name)
+        args.append(expression)
+        return run_mon_cli(args)
+
+    def list_notifications(self):
+        return run_mon_cli(['notification-list'])
+
+    def create_notification(self, name, address, notification_type):
+        return run_mon_cli(['notification-create', name, notification_type,
+                            address])
+
+    def delete_notification(self, notification_id):
+        run_mon_cli(['notification-delete', notification_id], useJson=False)
+
+    def get_alarm(self, alarm_id):
+        return run_mon_cli(['alarm-show', alarm_id])
+
+    def patch_alarm(self, alarm_id, state):
+        return run_mon_cli(['alarm-patch', alarm_id, '--state', state])
+
+    def list_alarms(self, alarm_definition_id):
+        return run_mon_cli(['alarm-list', '--alarm-definition',
+                            alarm_definition_id])
+
+    def alarm_history(self, alarm_id):
+        return run_mon_cli(['alarm-history', alarm_id])
+
+    def list_measurements(self, name, dimensions, start_time):
+        return run_mon_cli(['measurement-list', '--dimensions',
+                            format_dimensions(dimensions), name, start_time])
+
+    def create_metric(self, name, dimensions, value):
+        run_mon_cli(['metric-create', '--dimensions',
+                     format_dimensions(dimensions), name, str(value)],
+                    useJson=False)
+
+    # The CLI prints only the elements of a list, without the links needed
+    # to page through it, so lists are read whole
+    def iterate_alarm_definitions(self):
+        return iter(self.list_alarm_definitions())
+
+    def iterate_notifications(self):
+        return iter(self.list_notifications())
+
+    def iterate_alarms(self, alarm_definition_id):
+        return iter(self.list_alarms(alarm_definition_id))
+
+
+class ClientBackend(object):
+    """Uses monascaclient in process with one authenticated session.
+
+    The same environment variables the CLI reads are used to authenticate.
+    """
+    name = 'client'
+
+    def __init__(self):
+        from monascaclient import client
+        from monascaclient import ksclient
+
+        ks = ksclient.KSClient(username=os.environ['OS_USERNAME'],
+                               password=os.environ['OS_PASSWORD'],
+                               project_name=os.environ['OS_PROJECT_NAME'],
+                               auth_url=os.environ['OS_AUTH_URL'])
+        endpoint = os.environ.get('MONASCA_API_URL') or ks.monasca_url
+        self.client = client.Client('2_0', endpoint, token=ks.token)
+
+        http_client = self.client.http_client
+        json_request = http_client.json_request
+
+        def timed_request(method, url, **kwargs):
+            with timing.span(request_name(method, url), 'http'):
+                return json_request(method, url, **kwargs)
+        http_client.json_request = timed_request
+
+    def list_alarm_definitions(self):
+        return self.client.alarm_definitions.list()
+
+    def delete_alarm_definition(self, alarm_definition_id):
+        self.client.alarm_definitions.delete(alarm_id=alarm_definition_id)
+
+    def create_alarm_definition(self, name, expression, description=None,
+                                ok_notif_id=None, alarm_notif_id=None,
+                                undetermined_notif_id=None, match_by=None):
+        fields = {'name': name, 'expression': expression}
+        add_field_if_given(fields, 'description', description)
+        add_field_if_given(fields, 'match_by', match_by)
+        add_field_if_given(fields, 'alarm_actions', alarm_notif_id, True)
+        add_field_if_given(fields, 'ok_actions', ok_notif_id, True)
+        add_field_if_given(fields, 'undetermined_actions',
+                           undetermined_notif_id, True)
+        return self.client.alarm_definitions.create(**fields)
+
+    def list_notifications(self):
+        return self.client.notifications.list()
+
+    def create_notification(self, name, address, notification_type):
+        return self.client.notifications.create(name=name,
+                                                type=notification_type,
+                                                address=address)
+
+    def delete_notification(self, notification_id):
+        self.client.notifications.delete(notification_id=notification_id)
+
+    def get_alarm(self, alarm_id):
+        return self.client.alarms.get(alarm_id=alarm_id)
+
+    def patch_alarm(self, alarm_id, state):
+        return self.client.alarms.patch(alarm_id=alarm_id, state=state)
+
+    def list_alarms(self, alarm_definition_id):
+        return self.client.alarms.list(
+            alarm_definition_id=alarm_definition_id)
+
+    def alarm_history(self, alarm_id):
+        return self.client.alarms.history(alarm_id=alarm_id)
+
+    def list_measurements(self, name, dimensions, start_time):
+        return self.client.metrics.list_measurements(
+            name=name, dimensions=dimensions, start_time=start_time)
+
+    def create_metric(self, name, dimensions, value):
+        self.client.metrics.create(name=name, dimensions=dimensions,
+                                   value=value,
+                                   timestamp=int(time.time() * 1000))
+
+    def get_page(self, path, query):
+        """Returns the elements of one page and the query for the next page,
+        None if it is the last"""
+        resp, body = self.client.http_client.json_request(
+            'GET', path + '?' + query)
+        for link in body.get('links', []):
+            if link.get('rel') == 'next':
+                return body['elements'], urlparse.urlparse(link['href']).query
+        return body['elements'], None
+
+    def iterate_pages(self, path, params):
+        params = dict(params, limit=PAGE_SIZE)
+        return paging.iterate_pages(lambda query: self.get_page(path, query),
+                                    urllib.urlencode(params))
+
+    def iterate_alarm_definitions(self):
+        return self.iterate_pages('/alarm-definitions', {})
+
+    def iterate_notifications(self):
+        return self.iterate_pages('/notification-methods', {})
+
+    def iterate_alarms(self, alarm_definition_id):
+        return self.iterate_pages('/alarms',
+                                  {'alarm_definition_id': alarm_definition_id})
+
+
+BACKENDS = {
+    ProcessBackend.name: ProcessBackend,
+    ClientBackend.name: ClientBackend,
+}
+
+
+def set_backend(name):
+    """Select the backend used by the wrapper functions.
+
+    If the client backend can not be created the process backend is used
+    instead so the smoke test still runs. Returns the name of the backend
+    that was selected.
+    """
+    global _backend
+    try:
+        _backend = BACKENDS[name]()
+    except KeyError:
+        print('Unknown CLI backend {}'.format(name), file=sys.stderr)
+        sys.exit(1)
+    except Exception as e:
+        print('Unable to use {} backend, falling back to {}: {}'.format(
+              name, ProcessBackend.name, e), file=sys.stderr)
+        _backend = ProcessBackend()
+    return _backend.name
+
+
+def get_backend():
+    if _backend is None:
+        set_backend(os.environ.get('MONASCA_CLI_BACKEND', DEFAULT_BACKEND))
+    return _backend
 
 
 def find_obj_for_name(object_json, name):
@@ -17,33 +252,57 @@ def find_obj_for_name(object_json, name):
     return None
 
 
+def iterate_alarm_definitions():
+    return get_backend().iterate_alarm_definitions()
+
+
+def iterate_notifications():
+    return get_backend().iterate_notifications()
+
+
+def iterate_alarms(alarm_definition_id):
+    return get_backend().iterate_alarms(alarm_definition_id)
+
+
 def find_alarm_definition_by_name(name):
-    alarm_json = run_mon_cli(['alarm-definition-list'])
-    return find_obj_for_name(alarm_json, name)
+    return find_obj_for_name(iterate_alarm_definitions(), name)
 
 
 def delete_alarm_definition_if_exists(name):
     alarm_json = find_alarm_definition_by_name(name)
     if alarm_json:
-        run_mon_cli(['alarm-definition-delete', alarm_json['id']],
-                    useJson=False)
+        get_backend().delete_alarm_definition(alarm_json['id'])
+
+
+def delete_alarm_definition(alarm_definition_id):
+    get_backend().delete_alarm_definition(alarm_definition_id)
+
+
+def delete_notification(notification_id):
+    get_backend().delete_notification(notification_id)
 
 
 def delete_notification_if_exists(notification_name):
-    notification_json = run_mon_cli(['notification-list'])
-    notification = find_obj_for_name(notification_json, notification_name)
+    notification = find_obj_for_name(iterate_notifications(),
+                                     notification_name)
     if notification:
-        run_mon_cli(['notification-delete', notification['id']], useJson=False)
+        get_backend().delete_notification(notification['id'])
+
+
+def request_name(method, url):
+    return '{} {}'.format(method, ID_PATTERN.sub('/{id}', url.split('?')[0]))
 
 
 def run_mon_cli(args, useJson=True):
+    command = args[0]
     if useJson:
         args.insert(0, '--json')
-    args.insert(0, '/opt/monasca/bin/monasca')
+    args.insert(0, MONASCA_CLI)
     env = os.environ.copy()
     env['PYTHONIOENCODING'] = "utf-8"
     try:
-        stdout = subprocess.check_output(args, env=env)
+        with timing.span('monasca ' + command, 'subprocess'):
+            stdout = subprocess.check_output(args, env=env)
         if useJson:
             return json.loads(stdout)
         else:
@@ -57,8 +316,9 @@ def create_notification(notification_name,
                         notification_addr,
                         notification_type):
     print('Creating notification')
-    result_json = run_mon_cli(['notification-create', notification_name,
-                              notification_type, notification_addr])
+    result_json = get_backend().create_notification(notification_name,
+                                                    notification_addr,
+                                                    notification_type)
 
     # Parse out id
     notification_id = result_json['id']
@@ -66,13 +326,13 @@ def create_notification(notification_name,
 
 
 def get_alarm_state(alarm_id):
-    result_json = run_mon_cli(['alarm-show', alarm_id])
+    result_json = get_backend().get_alarm(alarm_id)
     return result_json['state']
 
 
 def change_alarm_state(alarm_id, new_state):
     print('Changing Alarm state to %s' % new_state)
-    result_json = run_mon_cli(['alarm-patch', alarm_id, "--state", new_state])
+    result_json = get_backend().patch_alarm(alarm_id, new_state)
     if result_json['state'] != new_state:
         print('Alarm patch failed, expected state of %s but was %s' %
               (result_json['state'], new_state), file=sys.stderr)
@@ -80,31 +340,52 @@ def change_alarm_state(alarm_id, new_state):
     return True
 
 
-def find_alarms_for_definition(alarm_definition_id):
-    result_json = run_mon_cli(['alarm-list', "--alarm-definition",
-                              alarm_definition_id])
-    return [alarm['id'] for alarm in result_json]
+def find_alarms_for_definition(alarm_definition_id, limit=None):
+    """Returns the ids of the alarms for the definition, at most limit of
+    them if given"""
+    alarms = itertools.islice(iterate_alarms(alarm_definition_id), limit)
+    return [alarm['id'] for alarm in alarms]
+
+
+def list_alarms_for_definition(alarm_definition_id):
+    return list(iterate_alarms(alarm_definition_id))
+
+
+def get_alarm_history(alarm_id):
+    return get_backend().alarm_history(alarm_id)
+
+
+def get_measurements(name, dimensions, start_time):
+    return get_backend().list_measurements(name, dimensions, start_time)
+
+
+def create_metric(name, dimensions, value):
+    get_backend().create_metric(name, dimensions, value)
 
 
 def create_alarm_definition(name, expression, description=None,
                             ok_notif_id=None, alarm_notif_id=None,
-                            undetermined_notif_id=None):
-    args = ['alarm-definition-create']
-    add_argument_if_given(args, '--description', description)
-    add_argument_if_given(args, '--alarm-actions', alarm_notif_id)
-    add_argument_if_given(args, '--ok-actions', ok_notif_id)
-    add_argument_if_given(args, '--undetermined-actions',
-                          undetermined_notif_id)
-    args.append(name)
-    args.append(expression)
+                            undetermined_notif_id=None, match_by=None):
     print('Creating alarm definition')
-    result_json = run_mon_cli(args)
+    result_json = get_backend().create_alarm_definition(
+        name, expression, description=description, ok_notif_id=ok_notif_id,
+        alarm_notif_id=alarm_notif_id,
+        undetermined_notif_id=undetermined_notif_id, match_by=match_by)
 
     # Parse out id
     return result_json['id']
 
 
+def format_dimensions(dimensions):
+    return ','.join(key + '=' + value for key, value in dimensions.items())
+
+
 def add_argument_if_given(args, arg, value):
     if value is not None:
         args.append(arg)
         args.append(value)
+
+
+def add_field_if_given(fields, field, value, as_list=False):
+    if value is not None:
+        fields[field] = [value] if as_list else value
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+""" Creates and removes the alarm definitions and notifications a test needs.
+
+    Each resource type is listed at most once to build a name to id index,
+    creates and deletes are made concurrently and everything created is
+    remembered so teardown() removes it all in one pass.
+"""
+from __future__ import print_function
+import sys
+import cli_wrapper
+import utils
+
+ALARM_DEFINITION = 'alarm definition'
+NOTIFICATION = 'notification'
+
+# Alarm definitions refer to notifications so they are deleted first
+TEARDOWN_ORDER = [ALARM_DEFINITION, NOTIFICATION]
+
+
+class FixtureManager(object):
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.indexes = {}
+        self.created = dict((kind, []) for kind in TEARDOWN_ORDER)
+
+    def _list(self, kind):
+        if kind == ALARM_DEFINITION:
+            return cli_wrapper.iterate_alarm_definitions()
+        return cli_wrapper.iterate_notifications()
+
+    def _delete(self, kind, object_id):
+        if kind == ALARM_DEFINITION:
+            cli_wrapper.delete_alarm_definition(object_id)
+        else:
+            cli_wrapper.delete_notification(object_id)
+
+    def index(self, kind):
+        """Returns the name to id index for kind, listing it the first
+        time"""
+        if kind not in self.indexes:
+            self.indexes[kind] = dict((obj['name'], obj['id'])
+                                      for obj in self._list(kind))
+        return self.indexes[kind]
+
+    def find(self, kind, name):
+        return self.index(kind).get(name)
+
+    def delete_existing(self, kind, names):
+        """Deletes every object of kind with one of the names, returns how
+        many were deleted"""
+        index = self.index(kind)
+        object_ids = [index.pop(name) for name in names if name in index]
+        utils.run_concurrently(lambda object_id: self._delete(kind, object_id),
+                               object_ids, self.workers)
+        return len(object_ids)
+
+    def _track(self, kind, names, outcomes):
+        """Remembers the objects which were created, then raises the first
+        error if any of the creates failed"""
+        created = [(name, object_id) for name, (object_id, error)
+                   in zip(names, outcomes) if error is None]
+        # Only keep an index current once something has asked for it
+        index = self.indexes.get(kind)
+        if index is not None:
+            index.update(created)
+        self.created[kind].extend(object_id for _, object_id in created)
+        utils.raise_first_error(outcomes)
+        return [object_id for object_id, _ in outcomes]
+
+    def create_notifications(self, notifications):
+        """Creates each (name, address, type) notification, returns their
+        ids in the same order"""
+        outcomes = utils.map_concurrently(
+            lambda args: cli_wrapper.create_notification(*args),
+            notifications, self.workers)
+        return self._track(NOTIFICATION, [args[0] for args in notifications],
+                           outcomes)
+
+    def create_notification(self, name, address, notification_type):
+        return self.create_notifications(
+            [(name, address, notification_type)])[0]
+
+    def create_alarm_definitions(self, definitions):
+        """Creates each alarm definition from a dict of the keyword arguments
+        of cli_wrapper.create_alarm_definition, returns their ids in the same
+        order"""
+        outcomes = utils.map_concurrently(
+            lambda fields: cli_wrapper.create_alarm_definition(**fields),
+            definitions, self.workers)
+        return self._track(ALARM_DEFINITION,
+                           [fields['name'] for fields in definitions],
+                           outcomes)
+
+    def create_alarm_definition(self, name, expression, **fields):
+        fields.update(name=name, expression=expression)
+        return self.create_alarm_definitions([fields])[0]
+
+    def teardown(self):
+        """Deletes everything this manager created, returns False if any of
+        it could not be deleted. Objects which were not deleted are still
+        remembered so a later teardown tries them again."""
+        passed = True
+        for kind in TEARDOWN_ORDER:
+            object_ids = self.created[kind]
+            outcomes = utils.map_concurrently(
+                lambda object_id: self._delete(kind, object_id),
+                object_ids, self.workers)
+            failed = [object_id for object_id, (_, error)
+                      in zip(object_ids, outcomes) if error is not None]
+            for object_id in failed:
+                print('Unable to delete {} {}'.format(kind, object_id),
+                      file=sys.stderr)
+            self.created[kind] = failed
+            removed = set(object_ids) - set(failed)
+            index = self.indexes.get(kind, {})
+            for name, object_id in list(index.items()):
+                if object_id in removed:
+                    del index[name]
+            passed = passed and not failed
+        return passed
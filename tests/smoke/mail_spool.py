@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+""" Incremental reader for the local mbox the notification engine sends
+    email to.
+
+    Only mail appended since the last scan is read, each message is parsed
+    and the notifications it holds are indexed by alarm id.
+"""
+from __future__ import print_function
+import email
+import os
+import re
+import subprocess
+import sys
+
+MESSAGE_START = re.compile(r'^From ', re.MULTILINE)
+STATE = re.compile(r'transitioned to the (.+?) state')
+ALARM_ID = re.compile(r'alarm_id:\s*(\S+)')
+
+
+class Mailbox(object):
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.pending = ''
+        self.notifications = {}
+
+    def skip_existing(self):
+        """Ignore all mail already in the mailbox"""
+        self.offset = self._size()
+        self.pending = ''
+
+    def _size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def _read_new(self):
+        """Returns everything appended since the last read"""
+        if self._size() < self.offset:
+            # The mailbox was truncated or replaced, start over
+            self.offset = 0
+            self.pending = ''
+        if os.access(self.path, os.R_OK):
+            with open(self.path, 'rb') as mbox:
+                mbox.seek(self.offset)
+                data = mbox.read()
+        elif os.path.exists(self.path):
+            args = ['sudo', 'tail', '-c', '+{}'.format(self.offset + 1),
+                    self.path]
+            try:
+                data = subprocess.check_output(args)
+            except subprocess.CalledProcessError as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+        else:
+            data = ''
+        self.offset += len(data)
+        return data
+
+    def scan(self):
+        """Reads new mail and indexes the notifications in it"""
+        new_data = self._read_new()
+        data = self.pending + new_data
+        starts = [match.start() for match in MESSAGE_START.finditer(data)]
+        if not starts:
+            self.pending = data
+            return
+        # A message is complete once the next one starts. The last one is
+        # held back until a later scan finds nothing was appended to it, a
+        # message caught mid-write also ends in a blank line after its
+        # headers or any paragraph of its body.
+        if not new_data and data.endswith('\n\n'):
+            ends = starts[1:] + [len(data)]
+            self.pending = ''
+        else:
+            ends = starts[1:]
+            self.pending = data[starts[-1]:]
+        for start, end in zip(starts, ends):
+            self._index(email.message_from_string(data[start:end]))
+
+    def _index(self, message):
+        for part in message.walk():
+            if part.get_content_maintype() != 'text':
+                continue
+            body = part.get_payload(decode=True) or ''
+            charset = part.get_content_charset() or 'utf-8'
+            body = body.decode(charset, 'replace')
+            state = STATE.search(body)
+            alarm_id = ALARM_ID.search(body)
+            if state and alarm_id:
+                self.notifications.setdefault(alarm_id.group(1), []).append(
+                    state.group(1))
+                return
+
+    def find(self, alarm_id):
+        """Returns the states notified for the alarm in the order received"""
+        self.scan()
+        return self.notifications.get(alarm_id, [])
@@ -0,0 +1,221 @@
+#!/opt/monasca/bin/python
+#
+"""notification_bench
+    Measures the throughput of the Notification Engine.
+
+    Creates a webhook notification pointing at a local sink and many alarm
+    definitions using it. Once the alarms exist their states are flipped in
+    bulk through the API and the sink times the arrival of the resulting
+    notifications. Reports the notifications per second of each round of
+    flips, from its first state change request to its last notification,
+    and the delivery latency from each request to its notification.
+
+    The expression should match metrics the agent already sends but never
+    trip, the threshold engine may still move alarms back to OK between
+    flips. Each flip is matched to a notification of its own transition,
+    by alarm, state and old state, and a flip that finds the alarm already
+    in the state is counted apart as it has no transition to notify.
+
+    This must be run on a node with the Notification Engine and the same
+    environment variables as the smoke test.
+"""
+
+from __future__ import print_function
+import argparse
+import random
+import sys
+import time
+import cli_wrapper
+import fixtures
+import stats
+import utils
+import waiter
+import webhook_sink
+
+NAME_PREFIX = 'Notification Bench'
+# Returned for an alarm that was already in the state it was flipped to
+UNCHANGED = 'unchanged'
+
+
+def parse_commandline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--definitions', type=int, default=20,
+                        help='number of alarm definitions to create')
+    parser.add_argument('-f', '--flips', type=int, default=4,
+                        help='number of state flips for every alarm')
+    parser.add_argument('-e', '--expression',
+                        default='max(cpu.system_perc) > 1000',
+                        help='alarm expression, should never trip')
+    parser.add_argument('-p', '--port', type=int, default=8090,
+                        help='port for the webhook sink')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='number of API requests to make at once')
+    parser.add_argument('-t', '--timeout', type=float, default=120,
+                        help='seconds to wait for alarms and notifications')
+    parser.add_argument('-b', '--backend', default=None,
+                        choices=sorted(cli_wrapper.BACKENDS),
+                        help='how to talk to the API')
+    return parser.parse_args()
+
+
+def create_definitions(manager, count, expression, notif_id):
+    run_id = random.randint(1, 1000000)
+    return manager.create_alarm_definitions(
+        [{'name': '{} {} {}'.format(NAME_PREFIX, run_id, index),
+          'expression': expression, 'ok_notif_id': notif_id,
+          'alarm_notif_id': notif_id} for index in range(count)])
+
+
+def wait_for_alarms(definition_ids, timeout, workers):
+    """Returns one alarm id for each definition, None if it was not created"""
+    def wait_for_alarm(definition_id):
+        result = waiter.wait_for(
+            lambda: cli_wrapper.find_alarms_for_definition(definition_id, 1),
+            timeout, 'Alarm creation')
+        return result.value[0] if result.value else None
+    return utils.run_concurrently(wait_for_alarm, definition_ids, workers)
+
+
+def flip_states(alarm_ids, state, workers):
+    """Changes the state of every alarm, returns (alarm_id, old_state,
+    state, time) for each change that succeeded and the number of alarms
+    which were already in the state, so had no transition to notify"""
+    def flip(alarm_id):
+        old_state = cli_wrapper.get_alarm_state(alarm_id)
+        if old_state == state:
+            return UNCHANGED
+        requested = time.time()
+        if cli_wrapper.change_alarm_state(alarm_id, state):
+            return alarm_id, old_state, state, requested
+        return None
+    changes = utils.run_concurrently(flip, alarm_ids, workers)
+    return ([change for change in changes
+             if change is not None and change is not UNCHANGED],
+            changes.count(UNCHANGED))
+
+
+def match_notifications(sink, flips):
+    """Returns {flip: time its notification was received} for every flip
+    that was delivered.
+
+    A flip is matched to the first notification of its transition received
+    after it was requested. Each notification is matched at most once, so
+    one the threshold engine sent when it moved the alarm back to OK is
+    not taken for a later flip's.
+    """
+    delivered = {}
+    matched = set()
+    for flip in flips:
+        alarm_id, old_state, state, requested = flip
+        for notification in sink.notifications(alarm_id):
+            if id(notification) in matched:
+                continue
+            if notification.state == state and \
+                    notification.old_state == old_state and \
+                    notification.received >= requested:
+                matched.add(id(notification))
+                delivered[flip] = notification.received
+                break
+    return delivered
+
+
+def round_throughput(round_flips, delivered):
+    """Returns the notifications delivered for a round and the seconds from
+    its first state change request to its last delivery"""
+    received = [delivered[flip] for flip in round_flips if flip in delivered]
+    if not received:
+        return 0, 0.0
+    first_request = min(requested for _, _, _, requested in round_flips)
+    return len(received), max(received) - first_request
+
+
+def print_throughput(rounds, delivered):
+    """Prints the notifications/s of each round and of all of them, only
+    the time from each round's first request to its last delivery counts so
+    the waits between rounds are left out"""
+    total_count, total_seconds = 0, 0.0
+    for index, (state, round_flips) in enumerate(rounds):
+        count, seconds = round_throughput(round_flips, delivered)
+        total_count += count
+        total_seconds += seconds
+        print('\tRound {} {:<5} {:>5} notifications in {:>7.2f}s {}'.format(
+              index + 1, state, count, seconds,
+              '{:.1f}/s'.format(count / seconds) if seconds > 0 else '-'))
+    if total_seconds > 0:
+        print('{:.1f} notifications/s over {} rounds'.format(
+              total_count / total_seconds, len(rounds)))
+
+
+def benchmark(args, sink):
+    manager = fixtures.FixtureManager(args.workers)
+    try:
+        notif_id = manager.create_notification(
+            '{} {}'.format(NAME_PREFIX, random.randint(1, 1000000)), sink.url,
+            'WEBHOOK')
+        definition_ids = create_definitions(manager, args.definitions,
+                                            args.expression, notif_id)
+        alarm_ids = wait_for_alarms(definition_ids, args.timeout,
+                                    args.workers)
+        missing = alarm_ids.count(None)
+        if missing:
+            print('{} alarm definitions have no alarm'.format(missing),
+                  file=sys.stderr)
+            return False
+        # Let the threshold engine settle the new alarms before flipping
+        waiter.wait_for(lambda: all(cli_wrapper.get_alarm_state(alarm_id) !=
+                                    'UNDETERMINED' for alarm_id in alarm_ids),
+                        args.timeout, 'Alarms evaluated')
+
+        flips = []
+        rounds = []
+        unchanged = 0
+        for flip in range(args.flips):
+            state = 'ALARM' if flip % 2 == 0 else 'OK'
+            round_flips, round_unchanged = flip_states(alarm_ids, state,
+                                                       args.workers)
+            flips.extend(round_flips)
+            rounds.append((state, round_flips))
+            unchanged += round_unchanged
+            # Only flip again once this round is delivered, so the
+            # notifications can be told apart
+            waiter.wait_for(
+                lambda: len(match_notifications(sink, round_flips)) ==
+                len(round_flips), args.timeout,
+                'Notifications for {} flips'.format(state))
+
+        delivered = match_notifications(sink, flips)
+        latencies = [delivered[flip] - flip[3] for flip in flips
+                     if flip in delivered]
+        print('Delivered {} of {} notifications'.format(len(latencies),
+                                                        len(flips)))
+        if unchanged:
+            print('{} flips found the alarm already in the state, so had no '
+                  'notification'.format(unchanged))
+        if latencies:
+            print_throughput(rounds, delivered)
+            print('Delivery latency ' +
+                  stats.format_percentiles(sorted(latencies)))
+        return len(latencies) == len(flips)
+    finally:
+        manager.teardown()
+
+
+def main():
+    utils.setup_cli()
+    args = parse_commandline_args()
+    if args.backend:
+        cli_wrapper.set_backend(args.backend)
+    print('Using {} API backend'.format(cli_wrapper.get_backend().name))
+
+    sink = webhook_sink.WebhookSink('127.0.0.1', args.port)
+    sink.start()
+    try:
+        passed = benchmark(args, sink)
+    finally:
+        sink.stop()
+    waiter.print_summary()
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
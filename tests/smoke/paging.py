@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+#
+""" Iterates over the paginated lists of the Monasca API.
+
+    The next page is fetched in the background while the elements of the
+    current one are consumed, so stopping early never gets more than one
+    extra page.
+"""
+import threading
+
+
+class PageFetch(threading.Thread):
+    """Gets one page of a list in the background"""
+
+    def __init__(self, get_page, cursor):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.get_page = get_page
+        self.cursor = cursor
+        self.page = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.page = self.get_page(self.cursor)
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.page
+
+
+def iterate_pages(get_page, cursor):
+    """Yields the elements of every page of a list.
+
+    get_page(cursor) returns the elements of a page and the cursor of the
+    next one, None on the last page. The first page is at cursor.
+    """
+    pending = PageFetch(get_page, cursor)
+    while pending is not None:
+        elements, next_cursor = pending.result()
+        pending = PageFetch(get_page, next_cursor) \
+            if next_cursor and elements else None
+        for element in elements:
+            yield element
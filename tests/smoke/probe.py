@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+""" Probes whether TCP ports are open.
+
+    All the connects in a batch are started at once with non-blocking
+    sockets and waited on together, so probing many ports takes about as
+    long as the slowest one and never longer than the timeout.
+"""
+import errno
+import os
+import select
+import socket
+import time
+
+IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+class ProbeResult(object):
+    def __init__(self, host, port, is_open, latency=None, reason=None):
+        self.host = host
+        self.port = port
+        self.is_open = is_open
+        self.latency = latency
+        self.reason = reason
+
+    def __str__(self):
+        if self.is_open:
+            return '{}:{} open in {:.1f}ms'.format(self.host, self.port,
+                                                   self.latency * 1000)
+        return '{}:{} not open, {}'.format(self.host, self.port, self.reason)
+
+
+def probe_ports(targets, timeout=5.0):
+    """Connects to each (host, port) in targets and returns a ProbeResult
+    for each in the same order.
+
+    No probe takes longer than timeout seconds and every socket is closed
+    before returning.
+    """
+    results = [None] * len(targets)
+    pending = {}
+    try:
+        for index, (host, port) in enumerate(targets):
+            sock = None
+            try:
+                address = socket.getaddrinfo(host, port, socket.AF_INET,
+                                             socket.SOCK_STREAM)[0][4]
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(0)
+                start = time.time()
+                status = sock.connect_ex(address)
+            except socket.error as e:
+                results[index] = ProbeResult(host, port, False, reason=str(e))
+                if sock is not None:
+                    sock.close()
+                continue
+            if status == 0:
+                results[index] = ProbeResult(host, port, True,
+                                             time.time() - start)
+                sock.close()
+            elif status in IN_PROGRESS:
+                pending[sock] = (index, host, port, start)
+            else:
+                results[index] = ProbeResult(host, port, False,
+                                             reason=os.strerror(status))
+                sock.close()
+
+        deadline = time.time() + timeout
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            _, writable, _ = select.select([], list(pending), [], remaining)
+            now = time.time()
+            for sock in writable:
+                index, host, port, start = pending.pop(sock)
+                status = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if status == 0:
+                    results[index] = ProbeResult(host, port, True,
+                                                 now - start)
+                else:
+                    results[index] = ProbeResult(host, port, False,
+                                                 reason=os.strerror(status))
+                sock.close()
+
+        for index, host, port, start in pending.values():
+            results[index] = ProbeResult(
+                host, port, False,
+                reason='timed out after {:.1f}s'.format(timeout))
+    finally:
+        for sock in pending:
+            sock.close()
+    return results
+
+
+def probe_port(host, port, timeout=5.0):
+    return probe_ports([(host, port)], timeout)[0]
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+""" Finds the running processes expected by the smoke tests with a single
+    scan of the process table.
+"""
+import re
+import time
+
+import psutil
+
+
+class ProcessInfo(object):
+    def __init__(self, name, pid, uptime, rss):
+        self.name = name
+        self.pid = pid
+        self.uptime = uptime
+        self.rss = rss
+
+    def __str__(self):
+        return '{} pid {} up {:.0f}s rss {:.1f}MB'.format(
+            self.name, self.pid, self.uptime, self.rss / (1024.0 * 1024.0))
+
+
+def scan_processes(names):
+    """Returns a dict of each name to the list of processes with that name in
+    their command line.
+
+    Each command line is read once and checked against all names with one
+    combined pattern, only matching processes are inspected further.
+    """
+    matcher = re.compile('|'.join(re.escape(name) for name in names))
+    found = dict((name, []) for name in names)
+    now = time.time()
+    for process in psutil.process_iter():
+        try:
+            # The arguments are joined with NUL so no name can match
+            # across two of them
+            cmdline = '\0'.join(process.cmdline())
+            if matcher.search(cmdline) is None:
+                continue
+            uptime = now - process.create_time()
+            rss = process.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+        for name in names:
+            if name in cmdline:
+                found[name].append(ProcessInfo(name, process.pid, uptime,
+                                               rss))
+    return found
+
+
+def missing_processes(names, found):
+    return [name for name in names if not found[name]]
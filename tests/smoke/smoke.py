@@ -39,10 +39,19 @@ import time
 import cli_wrapper
 import utils
 import datetime
-import psutil
+import fixtures
+import processes
 import smoke_configs
+import timing
+import alarm_transitions
+import urlparse
+import waiter
+import webhook_sink
 
 config = smoke_configs.test_config["default"]
+transition_listener = None
+notification_sink = None
+fixture_manager = fixtures.FixtureManager()
 
 
 # parse command line arguments
@@ -50,6 +59,16 @@ def parse_commandline_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', nargs='?', default='default',
                         help='select configuration <CONFIG>')
+    parser.add_argument('-b', '--backend', default=None,
+                        choices=sorted(cli_wrapper.BACKENDS),
+                        help='how to talk to the API, in process with '
+                             'monascaclient or by running the CLI')
+    parser.add_argument('-k', '--kafka', default=None,
+                        help='kafka hosts to watch for alarm state '
+                             'transitions, ex. -k "192.168.10.4:9092"')
+    parser.add_argument('-o', '--timing-dir', default=None,
+                        help='directory to write smoke-timing.jsonl and '
+                             'smoke-timing.xml to')
     return parser.parse_args()
 
 
@@ -65,31 +84,55 @@ def set_config(config_name):
 
 
 def get_metrics(name, dimensions, since):
-    dimensions_arg = ''
-    for key, value in dimensions.iteritems():
-        if dimensions_arg != '':
-            dimensions_arg = dimensions_arg + ','
-        dimensions_arg = dimensions_arg + key + '=' + value
-    return cli_wrapper.run_mon_cli(['measurement-list', '--dimensions',
-                                    dimensions_arg, name, since])
+    return cli_wrapper.get_measurements(name, dimensions, since)
 
 
 def cleanup(notification_name, alarm_definition_name):
-    cli_wrapper.delete_alarm_definition_if_exists(alarm_definition_name)
-    cli_wrapper.delete_notification_if_exists(notification_name)
+    """Removes anything left behind by an earlier run"""
+    fixture_manager.delete_existing(fixtures.ALARM_DEFINITION,
+                                    [alarm_definition_name])
+    fixture_manager.delete_existing(fixtures.NOTIFICATION, [notification_name])
 
 
 def wait_for_alarm_state_change(alarm_id, old_state):
     # Wait for it to change state
     print('Waiting for alarm to change state from {}'.format(old_state))
-    for x in range(0, 250):
-        time.sleep(1)
+    if transition_listener is not None:
+        return wait_for_alarm_transition(alarm_id, old_state)
+
+    def state_changed():
         state = cli_wrapper.get_alarm_state(alarm_id)
-        if state != old_state:
-            print('Alarm state changed to {} in {} seconds'.format(state, x))
-            return state
-    print('State never changed from {} in {} seconds'.format(old_state, x),
-          file=sys.stderr)
+        return state if state != old_state else None
+
+    result = waiter.wait_for(state_changed, 250,
+                             'Alarm state change from {}'.format(old_state))
+    if result.satisfied:
+        print('Alarm state changed to {} in {:.2f} seconds'.format(
+              result.value, result.elapsed))
+        return result.value
+    print('State never changed from {} in {:.0f} seconds'.format(
+          old_state, result.elapsed), file=sys.stderr)
+    return None
+
+
+def wait_for_alarm_transition(alarm_id, old_state):
+    start = time.time()
+    state = transition_listener.wait_for_transition(alarm_id, old_state, 250)
+    waiter.record('Alarm transition from {}'.format(old_state), state,
+                  time.time() - start)
+    if state is not None:
+        print('Alarm state changed to {} in {:.2f} seconds'.format(
+              state, time.time() - start))
+        return state
+
+    # The transition may have been missed, so ask the API before giving up
+    state = cli_wrapper.get_alarm_state(alarm_id)
+    if state != old_state:
+        print('Alarm state changed to {} but the transition was not seen on '
+              'Kafka'.format(state), file=sys.stderr)
+        return state
+    print('State never changed from {} in {:.0f} seconds'.format(
+          old_state, time.time() - start), file=sys.stderr)
     return None
 
 
@@ -101,7 +144,11 @@ def check_notifications(alarm_id, state_changes):
               file=sys.stderr)
         return False
 
-    notifications = utils.find_notifications(alarm_id, "root")
+    if notification_sink is not None:
+        notifications = get_webhook_notifications(alarm_id,
+                                                  len(state_changes))
+    else:
+        notifications = get_email_notifications(alarm_id, len(state_changes))
     if len(notifications) != len(state_changes):
         print('Expected {} notifications but only found {}'.format(
               len(state_changes), len(notifications)), file=sys.stderr)
@@ -115,11 +162,41 @@ def check_notifications(alarm_id, state_changes):
                   expected, actual, index+1), file=sys.stderr)
             return False
         index = index + 1
-    print('Received email notifications as expected')
+    print('Received {} notifications as expected'.format(
+          config['notification']['type'].lower()))
 
     return True
 
 
+def get_email_notifications(alarm_id, count):
+    # Notifications may still be on their way, new mail is cheap to check
+    waiter.wait_for(
+        lambda: len(utils.find_notifications(alarm_id, "root")) >= count,
+        60, 'Email notifications')
+    return utils.find_notifications(alarm_id, "root")
+
+
+def get_webhook_notifications(alarm_id, count):
+    start = time.time()
+    received = notification_sink.wait_for(alarm_id, count, 60)
+    waiter.record('Webhook notifications', len(received) >= count,
+                  time.time() - start)
+    for notification in received:
+        if notification.latency is not None:
+            print('{} notification delivered {:.2f} seconds after the state '
+                  'change'.format(notification.state, notification.latency))
+    return [notification.state for notification in received]
+
+
+def start_webhook_sink(address):
+    """Starts a sink listening on the port of the notification address"""
+    url = urlparse.urlparse(address)
+    sink = webhook_sink.WebhookSink(url.hostname, url.port)
+    sink.start()
+    print('Receiving webhook notifications on {}'.format(sink.url))
+    return sink
+
+
 def count_metrics(metric_name, metric_dimensions, since):
     # Query how many metrics there are for the Alarm
     metric_json = get_metrics(metric_name, metric_dimensions, since)
@@ -138,19 +215,20 @@ def ensure_at_least(actual, desired):
 
 def wait_for_alarm_creation(alarm_def_id):
     print('Waiting for alarm to be created for Alarm Definition {}'.format(alarm_def_id))
-    for x in range(0, 30):
-        time.sleep(1)
-        alarms = cli_wrapper.find_alarms_for_definition(alarm_def_id)
-        if len(alarms) == 1:
-            print('Alarm was created in {} seconds'.format(x))
-            return alarms[0]
-        elif len(alarms) > 1:
-            print('{} Alarms were created. Only expected 1'.format(len(alarms)),
-                  file=sys.stderr)
-            return None
-
-    print('Alarm was not created for Alarm Definition {} in {} seconds'.format(
-          alarm_def_id, x), file=sys.stderr)
+    result = waiter.wait_for(
+        lambda: cli_wrapper.find_alarms_for_definition(alarm_def_id, 2), 30,
+        'Alarm creation')
+    alarms = result.value
+    if len(alarms) == 1:
+        print('Alarm was created in {:.2f} seconds'.format(result.elapsed))
+        return alarms[0]
+    elif len(alarms) > 1:
+        print('{} Alarms were created. Only expected 1'.format(len(alarms)),
+              file=sys.stderr)
+        return None
+
+    print('Alarm was not created for Alarm Definition {} in {:.0f} seconds'.format(
+          alarm_def_id, result.elapsed), file=sys.stderr)
     return None
 
 
@@ -164,9 +242,11 @@ def smoke_test():
     statsd_metric_name = config['statsd_metric']['name']
     statsd_metric_dimensions = config['statsd_metric']['dimensions']
 
+    timing.phase('Cleanup')
     cleanup(notification_name, alarm_definition_name)
 
     # Query how many metrics there are for the Alarm
+    timing.phase('Initial metric count')
     hour_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
     hour_ago_str = hour_ago.strftime('%Y-%m-%dT%H:%M:%S') + 'Z'
     print('Getting metrics for {}{} '.format(metric_name, metric_dimensions))
@@ -186,16 +266,19 @@ def smoke_test():
         initial_statsd_num_metrics = 0
 
     start_time = time.time()
+    utils.skip_existing_notifications("root")
 
     # Create Notification through CLI
-    notif_id = cli_wrapper.create_notification(notification_name,
-                                               notification_addr,
-                                               notification_type)
+    timing.phase('Create notification')
+    notif_id = fixture_manager.create_notification(notification_name,
+                                                   notification_addr,
+                                                   notification_type)
 
     # Create Alarm through CLI
+    timing.phase('Create alarm definition')
     expression = config['alarm']['expression']
     description = config['alarm']['description']
-    alarm_def_id = cli_wrapper.create_alarm_definition(
+    alarm_def_id = fixture_manager.create_alarm_definition(
         alarm_definition_name,
         expression,
         description=description,
@@ -204,6 +287,7 @@ def smoke_test():
         undetermined_notif_id=notif_id)
 
     # Wait for an alarm to be created
+    timing.phase('Alarm creation')
     alarm_id = wait_for_alarm_creation(alarm_def_id)
 
     if alarm_id is None:
@@ -217,6 +301,7 @@ def smoke_test():
         return False, 'Alarm creation error'
 
     # Ensure it is created in the right state
+    timing.phase('Alarm state change')
     initial_state = 'UNDETERMINED'
     if not utils.check_alarm_state(alarm_id, initial_state):
         msg = 'Alarm is in an invalid initial state'
@@ -235,6 +320,7 @@ def smoke_test():
         return False, msg
     states.append(state)
 
+    timing.phase('Alarm state update')
     new_state = 'OK'
     states.append(new_state)
     if not cli_wrapper.change_alarm_state(alarm_id, new_state):
@@ -255,6 +341,7 @@ def smoke_test():
 
     # If the alarm changes state too fast, then there isn't time for the new
     # metric to arrive. Unlikely, but it has been seen
+    timing.phase('Metrics received')
     ensure_at_least(time.time() - start_time, 35)
     change_time = time.time() - start_time
 
@@ -264,31 +351,40 @@ def smoke_test():
         msg = ('No new metrics received for {}{} in {} seconds'.format(metric_name, metric_dimensions, change_time))
         return False, msg
     print('Received {} metrics in {} seconds'.format((final_num_metrics - initial_num_metrics),  change_time))
+    timing.phase('Alarm history')
     if not utils.check_alarm_history(alarm_id, states):
         msg = 'Invalid alarm history'
         return False, msg
 
     # Notifications are only sent out for the changes, so omit the first state
+    timing.phase('Notifications')
     if not check_notifications(alarm_id, states[1:]):
         msg = 'Could not find correct notifications for alarm {}'.format(alarm_id)
         return False, msg
 
     # Check that monasca statsd is sending metrics
+    timing.phase('Statsd metrics')
     # Metrics may take some time to arrive
     print('Waiting for statsd metrics')
-    for x in range(0,30):
-        final_statsd_num_metrics = count_metrics(statsd_metric_name, statsd_metric_dimensions, hour_ago_str)
-        if final_statsd_num_metrics > initial_statsd_num_metrics:
-            break
-        if x >= 29:
-            msg = 'No metrics received for statsd metric {}{} in {} seconds'.format(
-                  statsd_metric_name, statsd_metric_dimensions, time.time() - start_time)
-            return False, msg
-        time.sleep(1)
+
+    def statsd_metrics_received():
+        count = count_metrics(statsd_metric_name, statsd_metric_dimensions,
+                              hour_ago_str)
+        if count is not None and count > initial_statsd_num_metrics:
+            return count
+        return None
+
+    result = waiter.wait_for(statsd_metrics_received, 30, 'Statsd metrics')
+    if not result.satisfied:
+        msg = 'No metrics received for statsd metric {}{} in {} seconds'.format(
+              statsd_metric_name, statsd_metric_dimensions, time.time() - start_time)
+        return False, msg
+    final_statsd_num_metrics = result.value
     print('Received {0} metrics for {1}{2} in {3} seconds'.format(final_statsd_num_metrics - initial_statsd_num_metrics,
                                                                   statsd_metric_name,
                                                                   statsd_metric_dimensions,
                                                                   time.time() - start_time))
+    timing.end_phase()
 
     msg = ''
     return True, msg
@@ -297,25 +393,17 @@ def smoke_test():
 def find_processes():
     """Find_process is meant to validate that all the required processes
     are running before starting the smoke test """
-    process_missing = []
     process_list = config['system_vars']['expected_processes']
-
-    for process in process_list:
-        process_found_flag = False
-
-        for item in psutil.process_iter():
-            for cmd in item.cmdline():
-                if process in cmd:
-                    process_found_flag = True
-                    break
-
-        if not process_found_flag:
-            process_missing.append(process)
+    found = processes.scan_processes(process_list)
+    process_missing = processes.missing_processes(process_list, found)
 
     if len(process_missing) > 0:   # if processes were not found
         print ('Process = {} Not Found'.format(process_missing))
         return False
     else:
+        for process in process_list:
+            for info in found[process]:
+                print('\t{}'.format(info))
         print ('All Mini-Mon Processes Found')
         return True
 
@@ -334,21 +422,58 @@ def main():
     if not set_config(cmd_args.config):
         return 1
 
+    try:
+        return run_smoke_test(cmd_args)
+    finally:
+        timing.end_phase('Did not complete')
+        if cmd_args.timing_dir:
+            write_timing(cmd_args.timing_dir)
+
+
+def run_smoke_test(cmd_args):
+    global transition_listener
+    global notification_sink
+    if cmd_args.backend:
+        cli_wrapper.set_backend(cmd_args.backend)
+    print('Using {} API backend'.format(cli_wrapper.get_backend().name))
+
+    if config['notification']['type'] == 'WEBHOOK':
+        notification_sink = start_webhook_sink(config['notification']['addr'])
+
     print('*****VERIFYING HOST ENVIRONMENT*****')
+    timing.phase('Find processes')
     if find_processes():
+        timing.phase('Start transition listener')
+        transition_listener = alarm_transitions.start_listener(
+            cmd_args.kafka or config['system_vars']['kafka_hosts'])
         print('*****BEGIN TEST*****')
         complete, msg = smoke_test()
+        if transition_listener is not None:
+            transition_listener.stop()
+        if notification_sink is not None:
+            notification_sink.stop()
         if not complete:
+            timing.end_phase(msg)
             print('*****TEST FAILED*****', file=sys.stderr)
             print(msg, file=sys.stderr)
             return 1
     else:
+        timing.end_phase('Processes not found')
         return 1
 
-    cleanup(config['notification']['name'], config['alarm']['name'])
+    timing.phase('Teardown')
+    fixture_manager.teardown()
+    timing.end_phase()
+    waiter.print_summary()
     print('*****TEST COMPLETE*****')
     return 0
 
 
+def write_timing(timing_dir):
+    timing.write_json_lines(os.path.join(timing_dir, 'smoke-timing.jsonl'))
+    timing.write_junit(os.path.join(timing_dir, 'smoke-timing.xml'), 'smoke')
+    print('Wrote timing to {}'.format(timing_dir))
+
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -6,17 +6,19 @@ import kafka
 import glob
 import MySQLdb
 from monascaclient import ksclient
-import psutil
+import probe
+import processes
 import requests
 import shlex
 import smoke2_configs
-import socket
 import subprocess
 import sys
+import threading
+from multiprocessing.pool import ThreadPool
 
 config = smoke2_configs.test_config
 args = 0
-success = True
+port_probes = {}
 
 # successfully = '\033[5;40;32mSuccessfully\033[0m'
 # successful = '\033[5;40;32mSuccessful.\033[0m'
@@ -53,172 +55,207 @@ def parse_commandline_args():
                         default=config['default']['arg_defaults']['monapi'],
                         help='will check url api access on node. '
                              'ex. -api "192.168.10.4"')
+    parser.add_argument('-t', '--timeout', type=float, default=5.0,
+                        help='seconds to wait for each port to connect')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='number of checks to run at the same time')
     parser.add_argument('-v', '--verbose', action='store_true', default=0,
                         help='will display all checking info')
     return parser.parse_args()
 
 
-def find_processes():
-    global success
-    """Find_process is meant to validate that all the required processes
-    are running"""
-    process_missing = []
-    process_list = config['default']['check']['expected_processes']
+class CheckResult(object):
+    """The outcome of checking one component, optionally on one node.
+
+    Output is collected rather than printed so checks can run concurrently
+    and still be reported in a fixed order.
+    """
+
+    def __init__(self, component, node=None):
+        self.component = component
+        self.node = node
+        self.ok = True
+        self.lines = []
+
+    def info(self, line):
+        """Lines only shown in verbose mode"""
+        if args.verbose:
+            self.lines.append(line)
+
+    def error(self, line):
+        self.ok = False
+        self.lines.append(line)
+
+
+class Report(object):
+    """Collects check results and prints them grouped by component in the
+    order the components were added"""
+
+    def __init__(self):
+        self.components = []
+        self.results = {}
+
+    def add(self, component, node=None):
+        if component not in self.results:
+            self.components.append(component)
+            self.results[component] = []
+        result = CheckResult(component, node)
+        self.results[component].append(result)
+        return result
+
+    @property
+    def success(self):
+        return all(result.ok for results in self.results.values()
+                   for result in results)
+
+    def print_report(self):
+        for component in self.components:
+            results = self.results[component]
+            print('********VERIFYING {}********'.format(component))
+            for result in results:
+                for line in result.lines:
+                    print(line)
+            if all(result.ok for result in results):
+                print(successful)
+
 
-    for process in process_list:
-        process_found_flag = False
+def run_checks(checks, workers):
+    """Runs the (result, function, arguments) checks on at most workers
+    threads, each function is called with its result first"""
+    def run(check):
+        result, function, arguments = check
+        try:
+            function(result, *arguments)
+        except Exception as e:
+            result.error(error + ' {}'.format(e))
 
-        for item in psutil.process_iter():
-            for cmd in item.cmdline():
-                if process in cmd:
-                    process_found_flag = True
-                    break
+    if not checks:
+        return
+    pool = ThreadPool(min(workers, len(checks)))
+    try:
+        pool.map(run, checks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
 
-        if not process_found_flag:
-            process_missing.append(process)
+
+def split_nodes(node):
+    """Splits a comma separated node list, dropping any port"""
+    nodes = []
+    for nodeip in node.split(','):
+        if nodeip[-5:-4] == ':':
+            nodeip = nodeip[:-5]
+        nodes.append(nodeip)
+    return nodes
+
+
+def find_processes(result):
+    """Find_process is meant to validate that all the required processes
+    are running"""
+    process_list = config['default']['check']['expected_processes']
+    found = processes.scan_processes(process_list)
+    process_missing = processes.missing_processes(process_list, found)
 
     if len(process_missing) > 0:   # if processes were not found
-        print (error + ' Process = {} Not Found'
-               .format(process_missing))
-        success = False
+        result.error(error + ' Process = {} Not Found'
+                     .format(process_missing))
     else:
-        print(successful + ' All Processes are running.')
+        for process in process_list:
+            for info in found[process]:
+                result.info('\t{}'.format(info))
+        result.info(successful + ' All Processes are running.')
 
 
-def check_port(node, port):
+def check_port(result, node, port):
     """Returns False if port is open (for fail check)"""
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    result = sock.connect_ex((node, port))
-    if result == 0:
-        if args.verbose:
-            print(successful + " Port {} is open".format(port))
+    probe_result = port_probes.get((node, port))
+    if probe_result is None:
+        probe_result = probe.probe_port(node, port, args.timeout)
+    if probe_result.is_open:
+        result.info(successful + " Port {0} is open ({1:.1f}ms)".format(
+                    port, probe_result.latency * 1000))
         return False
     else:
-        print(error + " Port {0} is not open on node {1}".format(port,node))
+        result.error(error + " Port {0} is not open on node {1}: {2}".format(
+                     port, node, probe_result.reason))
         return True
 
 
-def debug_kafka(node):
-    global success
-    print('********VERIFYING KAFKA NODE(S)********')
-    node = node.split(',')
+def check_kafka(result, nodeip):
     topics = config['default']['kafka']['topics']
-    cluster_status = True
-    for nodeip in node:
-        if nodeip[-5:-4] == ':':
-            nodeip = nodeip[:-5]
-        fail = check_port(nodeip, 9092)
-        if fail:
-            cluster_status = False
-            continue
-        if args.verbose:
-            print('Checking topics on node {}:'.format(nodeip))
-        kafka_client = kafka.client.KafkaClient(nodeip + ':9092')
-        for topic in topics:
-            try:
-                kafka.consumer.SimpleConsumer(
-                    kafka_client,
-                    'Foo',
-                    topic,
-                    auto_commit=True,
-                    max_buffer_size=None)
-                if args.verbose:
-                    print('\t' + successfully + ' connected '
-                                                'to topic {}'.format(topic))
-            except KeyError:
-                print('\t' + error + ' Could not connect '
-                      'to topic {}'.format(topic))
-                cluster_status = False
-    if not cluster_status:
-        success = False
-    else:
-        print(successful)
+    fail = check_port(result, nodeip, 9092)
+    if fail:
+        return
+    result.info('Checking topics on node {}:'.format(nodeip))
+    kafka_client = kafka.client.KafkaClient(nodeip + ':9092')
+    for topic in topics:
+        try:
+            kafka.consumer.SimpleConsumer(
+                kafka_client,
+                'Foo',
+                topic,
+                auto_commit=True,
+                max_buffer_size=None)
+            result.info('\t' + successfully + ' connected '
+                                              'to topic {}'.format(topic))
+        except KeyError:
+            result.error('\t' + error + ' Could not connect '
+                         'to topic {}'.format(topic))
+
+
+def check_zookeeper(result, nodeip):
+    fail = check_port(result, nodeip, 2181)
+    if fail:
+        return
+    cmd = "nc " + nodeip + ' 2181'
+    ps = subprocess.Popen(('echo', 'ruok'), stdout=subprocess.PIPE)
+    try:
+        output = subprocess.check_output(shlex.split(cmd),
+                                         stdin=ps.stdout)
+        if output == 'imok':
+            result.info("cmd: echo ruok | " + cmd + " Response: {}"
+                        .format(output) + " " + successful)
+    except subprocess.CalledProcessError:
+        result.error(error + ' Node {} is not responding'.format(nodeip))
 
 
-def debug_zookeeper(node):
-    global success
-    print('*******VERIFYING ZOOKEEPER NODE(S)*******')
-    node = node.split(',')
-    cluster_status = True
-    for nodeip in node:
-        if nodeip[-5:-4] == ':':
-            nodeip = nodeip[:-5]
-        fail = check_port(nodeip, 2181)
-        if fail:
-            cluster_status = False
-            continue
-        cmd = "nc " + nodeip + ' 2181'
-        ps = subprocess.Popen(('echo', 'ruok'), stdout=subprocess.PIPE)
-        try:
-            output = subprocess.check_output(shlex.split(cmd),
-                                             stdin=ps.stdout)
-            if output == 'imok':
-                if args.verbose:
-                    print("cmd: echo ruok | " + cmd + " Response: {}"
-                          .format(output) + " " + successful)
-        except subprocess.CalledProcessError:
-            print(error + ' Node {} is not responding'.format(nodeip))
-            cluster_status = False
-    if not cluster_status:
-        success = False
-    else:
-        print(successful)
-
-
-def debug_mysql(node, mysql_user, mysql_pass):
-    global success
-    print('********VERIFYING MYSQL NODE********')
-    nodes = node.split(",")
-    cluster_status = True
-    for node in nodes:
-        fail = check_port(node, 3306)
-        if fail:
-            cluster_status = False
-            continue
-        schema = config['default']['mysql_schema']
-        try:
-            conn = MySQLdb.connect(
-                host=node,
-                user=mysql_user,
-                passwd=mysql_pass,
-                db='mon')
-            if args.verbose:
-                print(successfully + ' connected to node {}'.format(node))
-            conn.query('show tables')
-            result = conn.store_result()
-            if args.verbose:
-                print('Checking MYSQL Table Schema on node {}:'.format(node))
-            for x in range(0, result.num_rows()):
-                row = result.fetch_row()[0][0]
-                if row in schema:
-                    if args.verbose:
-                        print('\t' + successfully +
-                              ' matched table {}'.format(row))
-                else:
-                    print('\t' + error + ' Table {} does not '
-                          'match config'.format(row))
-                    cluster_status = False
-        except MySQLdb.OperationalError, e:
-            print(error + ' MySQL connection failed: {0} on node {1}'.format(e, node))
-            cluster_status = False
-    if not cluster_status:
-        success = False
-    else:
-        print(successful)
+def check_mysql(result, node, mysql_user, mysql_pass):
+    fail = check_port(result, node, 3306)
+    if fail:
+        return
+    schema = config['default']['mysql_schema']
+    try:
+        conn = MySQLdb.connect(
+            host=node,
+            user=mysql_user,
+            passwd=mysql_pass,
+            db='mon')
+        result.info(successfully + ' connected to node {}'.format(node))
+        conn.query('show tables')
+        tables = conn.store_result()
+        result.info('Checking MYSQL Table Schema on node {}:'.format(node))
+        for x in range(0, tables.num_rows()):
+            row = tables.fetch_row()[0][0]
+            if row in schema:
+                result.info('\t' + successfully +
+                            ' matched table {}'.format(row))
+            else:
+                result.error('\t' + error + ' Table {} does not '
+                             'match config'.format(row))
+    except MySQLdb.OperationalError, e:
+        result.error(error + ' MySQL connection failed: {0} on node {1}'
+                     .format(e, node))
 
 
-def debug_influx(node, influx_user, influx_pass):
-    global success
-    print('********VERIFYING INFLUXDB NODE********')
+def check_influx(result, node, influx_user, influx_pass):
     try:
         from influxdb import client
     except ImportError:
-        print("[WARNING]: InfluxDB Python Package is not installed!")
-        return 1
-    fail = check_port(node, 8086)
-    fail |= check_port(node, 8083)
-    if fail:
-        success = False
+        result.error("[WARNING]: InfluxDB Python Package is not "
+                     "installed!")
+        return
+    check_port(result, node, 8086)
+    check_port(result, node, 8083)
     try:
         conn = client.InfluxDBClient(
             node,
@@ -228,90 +265,88 @@ def debug_influx(node, influx_user, influx_pass):
             'mon'
         )
         conn.query('show series;')
-        if args.verbose:
-            print(successfully + ' connected to node {}'.format(node))
-        else:
-            print(successful)
+        result.info(successfully + ' connected to node {}'.format(node))
     except Exception, e:
-        print('{}'.format(e))
-        success = False
+        result.error('{}'.format(e))
 
 
-def debug_vertica():
-    global success
-    print('********VERIFYING VERTICA NODE********')
+def check_vertica(result):
     try:
         cmd = "sudo su dbadmin -c '/opt/vertica/bin/admintools -t view_cluster'"
         output = subprocess.check_output(shlex.split(cmd))
-        if args.verbose:
-            print("Running cmd: admintools -t view_cluster -d mon as user dbadmin")
-            print("Response: " + output)
+        result.info("Running cmd: admintools -t view_cluster -d mon as user "
+                    "dbadmin")
+        result.info("Response: " + output)
         if "DOWN" in output:
-            print(error + " Part of the cluster is DOWN: \n{0}".format(output))
-            success = False
-        else:
-            print(successful)
+            result.error(error + " Part of the cluster is DOWN: \n{0}"
+                         .format(output))
     except subprocess.CalledProcessError:
-        print(error + " Cannot connect to vertica")
-        success = False
-
-
-def debug_keystone(key_user, key_pass, project, auth_url):
-    keystone = {
-        'username': key_user,
-        'password': key_pass,
-        'project': project,
-        'auth_url': auth_url
-    }
-    ks_client = ksclient.KSClient(**keystone)
-    if args.verbose:
-        print(successfully + ' connected to keystone with '
-                             'token {}'.format(ks_client.token))
-    else:
-        print(successful)
-    return ks_client.token
-
-
-def debug_rest_urls(node, token):
-    global success
-    print('********VERIFYING REST API********')
-    nodes = node.split(",")
-    cluster_status = True
-    for node in nodes:
-        url = 'http://' + node + ":8070/"
-        fail = check_port(node, 8070)
-        if fail:
-            cluster_status = False
-            continue
-        try:
-            r = requests.request("GET", url, headers={'X-Auth-Token': token})
-            if r.status_code == 200:
-                version_id = r.json()['elements'][0]['id']
-                if args.verbose:
-                    print(successfully + ' connected to REST API on '
-                                         'node {}. Response (version id): {}'
-                          .format(node, version_id))
-            else:
-                print(error + ' unexpected response received: \n'
-                              '{}'.format(r.text))
-                cluster_status = False
-        except requests.ConnectionError as e:
-            print(error + ' connection error received from node {}'.format(node))
-            print("\t {}".format(e))
-            cluster_status = False
-        except Exception as e:
-            print(error + ' error received from node {}'.format(node))
-            print("\t {}".format(e))
-            cluster_status = False
-    if not cluster_status:
-        success = False
-    else:
-        print(successful)
-
-
-def debug_storm(node):
-    global success
-    print('********VERIFYING STORM********')
+        result.error(error + " Cannot connect to vertica")
+
+
+class KeystoneToken(object):
+    """Gets a keystone token once, shared by the checks that need one"""
+
+    def __init__(self, key_user, key_pass, project, auth_url):
+        self.keystone = {
+            'username': key_user,
+            'password': key_pass,
+            'project': project,
+            'auth_url': auth_url
+        }
+        self.lock = threading.Lock()
+        self.token = None
+        self.failure = None
+
+    def get(self):
+        with self.lock:
+            if self.token is None and self.failure is None:
+                try:
+                    self.token = ksclient.KSClient(**self.keystone).token
+                except Exception as e:
+                    self.failure = e
+            if self.failure is not None:
+                raise self.failure
+            return self.token
+
+
+def check_keystone(result, keystone_token):
+    token = keystone_token.get()
+    result.info(successfully + ' connected to keystone with '
+                               'token {}'.format(token))
+
+
+def check_rest_url(result, node, keystone_token):
+    url = 'http://' + node + ":8070/"
+    fail = check_port(result, node, 8070)
+    if fail:
+        return
+    try:
+        token = keystone_token.get()
+    except Exception as e:
+        result.error(error + ' no keystone token for node {}: {}'
+                     .format(node, e))
+        return
+    try:
+        r = requests.request("GET", url, headers={'X-Auth-Token': token})
+        if r.status_code == 200:
+            version_id = r.json()['elements'][0]['id']
+            result.info(successfully + ' connected to REST API on '
+                                       'node {}. Response (version id): {}'
+                        .format(node, version_id))
+        else:
+            result.error(error + ' unexpected response received: \n'
+                                 '{}'.format(r.text))
+    except requests.ConnectionError as e:
+        result.error(error + ' connection error received from node {}'
+                     .format(node))
+        result.error("\t {}".format(e))
+    except Exception as e:
+        result.error(error + ' error received from node {}'.format(node))
+        result.error("\t {}".format(e))
+
+
+def check_storm(result, node):
     cmd = "/opt/storm/apache*"
     cmd = glob.glob(cmd)[0] + "/bin/storm list"
     grep = "grep 'ACTIVE'"
@@ -321,107 +356,122 @@ def debug_storm(node):
         if output:
             output = output[:27]
             output = " ".join(output.split())
-            if args.verbose:
-                print(successful + " Storm status: {}".format(output))
-            else:
-                print(successful)
+            result.info(successful + " Storm status: {}".format(output))
     except Exception, e:
-        print(error + " {}".format(e))
-        success = False
+        result.error(error + " {}".format(e))
 
 
-def stage_one(single=None, zoo=None, kafka=None):
-    global success
-    if single:
-        debug_zookeeper(single)
-    elif zoo:
-        debug_zookeeper(zoo)
-    else:
-        print(error + ' Could not parse zookeeper node!')
-        success = False
+# The ports each check connects to on the node passed as its first argument
+CHECK_PORTS = {
+    check_zookeeper: (2181,),
+    check_kafka: (9092,),
+    check_mysql: (3306,),
+    check_influx: (8086, 8083),
+    check_rest_url: (8070,),
+}
+
+
+def probe_check_ports(checks):
+    """Probes the ports of all checks in one batch before they run"""
+    targets = sorted(set((arguments[0], port)
+                         for result, function, arguments in checks
+                         for port in CHECK_PORTS.get(function, ())))
+    port_probes.update(zip(targets, probe.probe_ports(targets, args.timeout)))
 
-    if single:
-        debug_kafka(single)
-    elif kafka:
-        debug_kafka(kafka)
+
+def stage_one(report, checks, single=None, zoo=None, kafka=None):
+    zoo = single or zoo
+    if zoo:
+        for nodeip in split_nodes(zoo):
+            checks.append((report.add('ZOOKEEPER NODE(S)', nodeip),
+                           check_zookeeper, (nodeip,)))
+    else:
+        report.add('ZOOKEEPER NODE(S)').error(
+            error + ' Could not parse zookeeper node!')
+
+    kafka = single or kafka
+    if kafka:
+        for nodeip in split_nodes(kafka):
+            checks.append((report.add('KAFKA NODE(S)', nodeip),
+                           check_kafka, (nodeip,)))
     else:
-        print(error + ' Could not parse kafka node!')
-        success = False
+        report.add('KAFKA NODE(S)').error(
+            error + ' Could not parse kafka node!')
 
 
-def stage_two(single=None, mysql=None, dbtype=None, db=None):
-    global success
+def stage_two(report, checks, single=None, mysql=None, dbtype=None, db=None):
     mysql_user = config['mysql']['user']
     mysql_pass = config['mysql']['pass']
+    mysql = single or mysql
     if mysql_user and mysql_pass:
-        if single:
-            debug_mysql(single, mysql_user, mysql_pass)
-        elif mysql:
-            debug_mysql(mysql, mysql_user, mysql_pass)
+        if mysql:
+            for node in mysql.split(','):
+                checks.append((report.add('MYSQL NODE', node), check_mysql,
+                               (node, mysql_user, mysql_pass)))
         else:
-            print(error + ' Could not parse node for mysql')
-            success = False
+            report.add('MYSQL NODE').error(
+                error + ' Could not parse node for mysql')
     else:
-        print(error + ' Could not parse mysql user/pass')
-        success = False
+        report.add('MYSQL NODE').error(
+            error + ' Could not parse mysql user/pass')
 
     if dbtype == 'vertica':
-        debug_vertica()
+        checks.append((report.add('VERTICA NODE'), check_vertica, ()))
     else:
         influx_user = config['influx']['user']
         influx_pass = config['influx']['pass']
         influx_node = config['influx']['node']
         if single:
-            debug_influx(single, influx_user, influx_pass)
+            influx_node = single
+        elif db:
+            influx_node = db
+        elif influx_node and influx_node[0] == 'h':
+            influx_node = influx_node[7:-5]
+        if influx_node:
+            checks.append((report.add('INFLUXDB NODE', influx_node),
+                           check_influx,
+                           (influx_node, influx_user, influx_pass)))
         else:
-            if db:
-                debug_influx(db, influx_user, influx_pass)
-            elif influx_node:
-                if influx_node[0] == 'h':
-                    influx_node = influx_node[7:-5]
-                    debug_influx(influx_node, influx_user, influx_pass)
-                else:
-                    debug_influx(influx_node, influx_user, influx_pass)
-            else:
-                print(error + " Could not parse influxdb node")
-                success = False
+            report.add('INFLUXDB NODE').error(
+                error + " Could not parse influxdb node")
 
 
-def stage_three(single=None, monapi=None):
-    global success
-    print('*****VERIFYING KEYSTONE*****')
+def stage_three(report, checks, single=None, monapi=None):
     key_user = config['keystone']['user']
     key_pass = config['keystone']['pass']
     key_host = config['keystone']['host']
+    keystone_token = None
     if key_host:
         auth_url = "http://" + key_host + ':35357/v3'
         if key_user and key_pass:
-            try:
-                token = debug_keystone(key_user, key_pass, 'test', auth_url)
-            except Exception, e:
-                print(error + ' {}'.format(e))
-                success = False
+            keystone_token = KeystoneToken(key_user, key_pass, 'test',
+                                           auth_url)
+            checks.append((report.add('KEYSTONE'), check_keystone,
+                           (keystone_token,)))
         else:
-            print(error + ' Could not parse keystone user/pass')
-            success = False
+            report.add('KEYSTONE').error(
+                error + ' Could not parse keystone user/pass')
     else:
-        print(error + ' Could not parse keystone node')
-        success = False
-
-    if single:
-        debug_rest_urls(single, token)
-    elif monapi:
-        debug_rest_urls(monapi, token)
+        report.add('KEYSTONE').error(error + ' Could not parse keystone node')
+
+    monapi = single or monapi
+    if not monapi:
+        report.add('REST API').error(
+            error + ' Could not parse node for REST API')
+    elif keystone_token is None:
+        report.add('REST API').error(
+            error + ' No keystone token to check the REST API with')
     else:
-        print(error + ' Could not parse node for REST API')
-        success = False
+        for node in monapi.split(','):
+            checks.append((report.add('REST API', node), check_rest_url,
+                           (node, keystone_token)))
 
     storm_node = config['storm']
     if storm_node:
-        debug_storm(storm_node)
+        checks.append((report.add('STORM', storm_node), check_storm,
+                       (storm_node,)))
     else:
-        print(error + ' Could not parse storm node')
-        success = False
+        report.add('STORM').error(error + ' Could not parse storm node')
 
 
 def main():
@@ -429,22 +479,30 @@ def main():
     global args
     args = parse_commandline_args()
 
+    report = Report()
+    checks = []
+
     # Stage One
     # Will check Zookeeper and Kafka
-    stage_one(args.single, args.zoo, args.kafka)
+    stage_one(report, checks, args.single, args.zoo, args.kafka)
 
-    print('*****VERIFYING HOST SERVICES/PROCESSES*****')
-    find_processes()
+    checks.append((report.add('HOST SERVICES/PROCESSES'), find_processes, ()))
 
     # Stage Two
     # Will check MySQL and vertica/influxdb
-    stage_two(args.single, args.mysql, args.dbtype, args.db)
+    stage_two(report, checks, args.single, args.mysql, args.dbtype, args.db)
 
     # Stage Three
     # Will check keystone, REST API, and Storm
-    stage_three(args.single, args.monapi)
+    stage_three(report, checks, args.single, args.monapi)
+
+    probe_check_ports(checks)
+
+    # None of the checks depend on each other so they all run concurrently
+    run_checks(checks, args.workers)
+    report.print_report()
 
-    if not success:
+    if not report.success:
         print('*****TESTS FAILED*****')
         return 1
 
@@ -10,6 +10,7 @@ system_vars = {
                                'kafka', 'zookeeper.jar', 'monasca-api',
                                'apache-storm', 'mysqld'),
         'mail_host': 'localhost',
+        'kafka_hosts': 'localhost:9092',
         'metric_host': subprocess.check_output(['hostname', '-f']).strip()},
 }
 
@@ -49,7 +50,8 @@ test_config = {
 
         'notification': {
             'name': 'Smoke Test Webhook',
-            'addr': 'http://127.0.0.1:8070',
+            # Received by the sink smoke.py starts for this config
+            'addr': 'http://127.0.0.1:8090',
             'type': 'WEBHOOK'},
 
         'alarm': {
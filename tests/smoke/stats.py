@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+#
+""" Summarizes the latencies measured by the tests and benchmarks.
+"""
+import math
+
+
+def percentile(sorted_values, fraction):
+    """Nearest rank percentile of an already sorted list"""
+    index = int(math.ceil(fraction * len(sorted_values))) - 1
+    return sorted_values[max(0, index)]
+
+
+def format_percentiles(sorted_values):
+    return 'p50 {:.2f}s p90 {:.2f}s p99 {:.2f}s max {:.2f}s'.format(
+        percentile(sorted_values, 0.5), percentile(sorted_values, 0.9),
+        percentile(sorted_values, 0.99), sorted_values[-1])
@@ -0,0 +1,268 @@
+#!/opt/monasca/bin/python
+#
+"""thresh_bench
+    Measures how long the Threshold Engine takes to evaluate an alarm.
+
+    Each round creates alarm definitions on a metric only this benchmark
+    sends, with match_by on a target dimension so every definition gets one
+    alarm per target. Values below the threshold are posted for every
+    target until all alarms are OK, then every target crosses the threshold
+    and the time from posting each crossing value to its alarm going to
+    ALARM is measured. Rounds are repeated for each cardinality so the
+    latency can be compared as the number of sub alarms grows.
+
+    Transitions are timed from the alarm-state-transitions topic when Kafka
+    is reachable, otherwise by polling the API every --poll seconds which
+    limits the resolution to that interval. The Threshold Engine evaluates
+    alarms once per period (60 seconds) so latencies up to a period are
+    expected, any more is time spent in the topology.
+
+    This must be run with the same environment variables as the smoke test.
+"""
+
+from __future__ import print_function
+import argparse
+import random
+import sys
+import threading
+import time
+import alarm_transitions
+import cli_wrapper
+import fixtures
+import stats
+import utils
+import waiter
+
+NAME_PREFIX = 'Threshold Bench'
+METRIC_NAME = 'thresh_bench'
+THRESHOLD = 10
+BELOW = 0
+ABOVE = 100
+
+
+def parse_commandline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--cardinalities', default='1,10,100',
+                        help='comma separated number of targets per round')
+    parser.add_argument('-d', '--definitions', type=int, default=1,
+                        help='number of alarm definitions in each round')
+    parser.add_argument('-i', '--interval', type=float, default=10,
+                        help='seconds between posting metrics for a target')
+    parser.add_argument('-p', '--poll', type=float, default=1,
+                        help='seconds between polls when not using Kafka')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='number of API requests to make at once')
+    parser.add_argument('-t', '--timeout', type=float, default=300,
+                        help='seconds to wait for alarms and transitions')
+    parser.add_argument('-k', '--kafka', default='localhost:9092',
+                        help='Kafka to read alarm transitions from, empty '
+                             'to poll the API')
+    parser.add_argument('-b', '--backend', default=None,
+                        choices=sorted(cli_wrapper.BACKENDS),
+                        help='how to talk to the API')
+    return parser.parse_args()
+
+
+class FeederError(Exception):
+    pass
+
+
+class Feeder(object):
+    """Posts a value for every target each interval in a background thread.
+
+    cross() switches to a value above the threshold and posts it right away,
+    the time each target's first value above the threshold was sent is kept
+    in crossed. check() raises FeederError once the thread has stopped on an
+    error.
+    """
+
+    def __init__(self, dimensions, interval, workers):
+        self.dimensions = dimensions
+        self.interval = interval
+        self.workers = workers
+        self.value = BELOW
+        self.crossed = {}
+        self.wake = threading.Event()
+        self.running = False
+        self.thread = None
+        self.error = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def cross(self):
+        self.value = ABOVE
+        self.wake.set()
+
+    def _post(self, dimensions):
+        value = self.value
+        posted = time.time()
+        try:
+            cli_wrapper.create_metric(METRIC_NAME, dimensions, value)
+        except Exception as e:
+            print('Unable to post metric: {}'.format(e), file=sys.stderr)
+            return
+        if value == ABOVE:
+            self.crossed.setdefault(dimensions['target'], posted)
+
+    def _run(self):
+        try:
+            while self.running:
+                utils.run_concurrently(self._post, self.dimensions,
+                                       self.workers)
+                self.wake.wait(self.interval)
+                self.wake.clear()
+        # run_mon_cli exits on failure, which would end the thread silently
+        except (Exception, SystemExit) as e:
+            self.error = e
+            print('Unable to post metrics, the feeder stopped: {!r}'.format(e),
+                  file=sys.stderr)
+
+    def check(self):
+        if self.running and not self.thread.is_alive():
+            raise FeederError('The feeder stopped: {!r}'.format(self.error))
+
+
+def alarm_targets(definition_ids, workers):
+    """Returns {alarm_id: (target, state)} for every alarm of the
+    definitions"""
+    alarms = {}
+    for result in utils.run_concurrently(
+            cli_wrapper.list_alarms_for_definition, definition_ids, workers):
+        for alarm in result:
+            target = alarm['metrics'][0]['dimensions']['target']
+            alarms[alarm['id']] = (target, alarm['state'])
+    return alarms
+
+
+def wait_for_ok(definition_ids, expected, feeder, args):
+    """Waits for all alarms to exist and be OK, returns {alarm_id: target}"""
+    def all_ok():
+        feeder.check()
+        alarms = alarm_targets(definition_ids, args.workers)
+        if len(alarms) < expected or \
+                any(state != 'OK' for _, state in alarms.values()):
+            return None
+        return dict((alarm_id, target)
+                    for alarm_id, (target, _) in alarms.items())
+    return waiter.wait_for(all_ok, args.timeout,
+                           'All {} alarms OK'.format(expected)).value
+
+
+def wait_for_alarm(alarms, definition_ids, listener, feeder, args):
+    """Returns {alarm_id: time the alarm was seen in ALARM}"""
+    seen = {}
+
+    def from_listener():
+        feeder.check()
+        for alarm_id in alarms:
+            if alarm_id not in seen:
+                received = listener.transition_time(alarm_id, 'ALARM')
+                if received is not None:
+                    seen[alarm_id] = received
+        return len(seen) == len(alarms)
+
+    def from_api():
+        feeder.check()
+        now = time.time()
+        for alarm_id, (_, state) in alarm_targets(definition_ids,
+                                                  args.workers).items():
+            if state == 'ALARM':
+                seen.setdefault(alarm_id, now)
+        return len(seen) == len(alarms)
+
+    poll = waiter.Backoff(initial=args.poll, factor=1, maximum=args.poll,
+                          jitter=0)
+    waiter.wait_for(from_listener if listener else from_api, args.timeout,
+                    'All {} alarms in ALARM'.format(len(alarms)), poll)
+    return seen
+
+
+def run_round(cardinality, run_id, listener, args):
+    """Returns the latencies for one round, None if the alarms were not
+    all OK before crossing the threshold"""
+    dimensions = [{'run': run_id, 'target': str(index)}
+                  for index in range(cardinality)]
+    expression = 'max({}{{run={}}}) > {}'.format(METRIC_NAME, run_id,
+                                                  THRESHOLD)
+    manager = fixtures.FixtureManager(args.workers)
+    feeder = Feeder(dimensions, args.interval, args.workers)
+    try:
+        definition_ids = manager.create_alarm_definitions(
+            [{'name': '{} {} {}'.format(NAME_PREFIX, run_id, index),
+              'expression': expression, 'match_by': ['target']}
+             for index in range(args.definitions)])
+        feeder.start()
+        alarms = wait_for_ok(definition_ids, cardinality * args.definitions,
+                             feeder, args)
+        if not alarms:
+            print('Alarms never all went to OK', file=sys.stderr)
+            return None
+        feeder.cross()
+        feeder.check()
+        seen = wait_for_alarm(alarms, definition_ids, listener, feeder, args)
+        return [seen[alarm_id] - feeder.crossed[target]
+                for alarm_id, target in alarms.items()
+                if alarm_id in seen and target in feeder.crossed]
+    finally:
+        feeder.stop()
+        manager.teardown()
+
+
+def print_curve(curve, definitions):
+    print('Evaluation latency by cardinality ({} definitions):'.format(
+          definitions))
+    for cardinality, latencies in curve:
+        alarms = cardinality * definitions
+        if latencies:
+            print('\t{:>6} alarms {:>6} in ALARM {}'.format(
+                  alarms, len(latencies),
+                  stats.format_percentiles(sorted(latencies))))
+        else:
+            print('\t{:>6} alarms      0 in ALARM'.format(alarms))
+
+
+def main():
+    utils.setup_cli()
+    args = parse_commandline_args()
+    if args.backend:
+        cli_wrapper.set_backend(args.backend)
+    print('Using {} API backend'.format(cli_wrapper.get_backend().name))
+    cardinalities = [int(value) for value in args.cardinalities.split(',')]
+
+    listener = alarm_transitions.start_listener(args.kafka)
+    curve = []
+    passed = True
+    try:
+        for cardinality in cardinalities:
+            run_id = str(random.randint(1, 1000000))
+            print('Round with {} targets'.format(cardinality))
+            try:
+                latencies = run_round(cardinality, run_id, listener, args)
+            except FeederError as e:
+                print('Stopping the benchmark: {}'.format(e), file=sys.stderr)
+                passed = False
+                break
+            if latencies is None or \
+                    len(latencies) < cardinality * args.definitions:
+                passed = False
+            curve.append((cardinality, latencies or []))
+    finally:
+        if listener is not None:
+            listener.stop()
+    print_curve(curve, args.definitions)
+    waiter.print_summary()
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
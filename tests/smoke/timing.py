@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+""" Records how long each part of a test run takes.
+
+    A span has a name, a kind, the time it started and its duration. The
+    smoke test records a 'phase' span for each of its steps, every request
+    made to the API is recorded as an 'http' or 'subprocess' span and every
+    wait as a 'wait' span. The spans can be written as JSON lines and as
+    JUnit XML, which Jenkins can trend across builds.
+"""
+from __future__ import print_function
+import contextlib
+import json
+import threading
+import time
+from xml.sax.saxutils import escape
+from xml.sax.saxutils import quoteattr
+
+spans = []
+_lock = threading.Lock()
+_phase = None
+
+
+class Span(object):
+    def __init__(self, name, kind, start, duration, error=None):
+        self.name = name
+        self.kind = kind
+        self.start = start
+        self.duration = duration
+        self.error = error
+
+    def to_json(self):
+        return json.dumps({'name': self.name, 'kind': self.kind,
+                           'start': self.start, 'duration': self.duration,
+                           'error': self.error})
+
+
+def record(name, kind, start, duration, error=None):
+    result = Span(name, kind, start, duration, error)
+    with _lock:
+        spans.append(result)
+    return result
+
+
+@contextlib.contextmanager
+def span(name, kind):
+    """Records the time spent in the with block, an exception is recorded
+    as the error of the span"""
+    start = time.time()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = str(e) or e.__class__.__name__
+        raise
+    finally:
+        record(name, kind, start, time.time() - start, error)
+
+
+def phase(name):
+    """Ends the current phase and starts a new one"""
+    global _phase
+    end_phase()
+    _phase = (name, time.time())
+
+
+def end_phase(error=None):
+    """Ends the current phase, if any, recording error as why it failed"""
+    global _phase
+    if _phase is not None:
+        name, start = _phase
+        _phase = None
+        record(name, 'phase', start, time.time() - start, error)
+
+
+def write_json_lines(path):
+    with open(path, 'w') as output:
+        for result in spans:
+            output.write(result.to_json() + '\n')
+
+
+def write_junit(path, suite_name):
+    """Writes one test suite per kind of span.
+
+    Spans with the same name and kind, like repeated calls to the same API
+    request, are reported as one test case with their total time so the
+    test case names stay the same from build to build.
+    """
+    groups = {}
+    order = []
+    for result in spans:
+        key = (result.kind, result.name)
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(result)
+
+    kinds = []
+    for kind, _ in order:
+        if kind not in kinds:
+            kinds.append(kind)
+
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<testsuites>']
+    for kind in kinds:
+        keys = [k for k in order if k[0] == kind]
+        failures = sum(1 for k in keys
+                       if any(s.error for s in groups[k]))
+        total = sum(s.duration for k in keys for s in groups[k])
+        lines.append('  <testsuite name={} tests="{}" failures="{}" '
+                     'time="{:.3f}">'.format(
+                         quoteattr('{}.{}'.format(suite_name, kind)),
+                         len(keys), failures, total))
+        for key in keys:
+            results = groups[key]
+            durations = [s.duration for s in results]
+            lines.append('    <testcase classname={} name={} time="{:.3f}">'
+                         .format(quoteattr('{}.{}'.format(suite_name, kind)),
+                                 quoteattr(key[1]), sum(durations)))
+            errors = [s.error for s in results if s.error]
+            if errors:
+                lines.append('      <failure message={}/>'.format(
+                             quoteattr(errors[0])))
+            lines.append('      <system-out>{}</system-out>'.format(escape(
+                         '{} calls, max {:.3f}s'.format(len(durations),
+                                                        max(durations)))))
+            lines.append('    </testcase>')
+        lines.append('  </testsuite>')
+    lines.append('</testsuites>')
+    with open(path, 'w') as output:
+        output.write('\n'.join(lines) + '\n')
@@ -1,10 +1,10 @@
 from __future__ import print_function
 import cli_wrapper
+import mail_spool
 import os
-import re
-import subprocess
 import sys
-import time
+import waiter
+from multiprocessing.pool import ThreadPool
 
 """
     Utility methods for testing
@@ -16,16 +16,21 @@ OS_PASSWORD = 'password'
 OS_PROJECT_NAME = 'mini-mon'
 OS_AUTH_URL = 'http://192.168.10.5:35357/v3/'
 
+mailboxes = {}
+
 
 def check_alarm_history(alarm_id, states):
     transitions = len(states) - 1
     print('Checking Alarm History')
     # May take some time for Alarm history to flow all the way through
-    for _ in range(0, 20):
-        result_json = cli_wrapper.run_mon_cli(['alarm-history', alarm_id])
-        if len(result_json) >= transitions:
-            break
-        time.sleep(4)
+    history = []
+
+    def history_complete():
+        history[:] = cli_wrapper.get_alarm_history(alarm_id)
+        return len(history) >= transitions
+
+    waiter.wait_for(history_complete, 80, 'Alarm history')
+    result_json = history
 
     result = True
     if transitions != len(result_json):
@@ -54,6 +59,47 @@ def check_alarm_history(alarm_id, states):
     return result
 
 
+def _capture_errors(function):
+    def call(item):
+        try:
+            return function(item), None
+        # run_mon_cli exits on failure, a SystemExit escaping into the pool
+        # would kill its worker thread and leave map() waiting forever
+        except BaseException:
+            return None, sys.exc_info()
+    return call
+
+
+def map_concurrently(function, items, workers):
+    """Calls function on each item using up to workers threads, returns
+    (result, exc_info) for each item in the order of items, exc_info being
+    None when the call succeeded"""
+    items = list(items)
+    if not items:
+        return []
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(_capture_errors(function), items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def raise_first_error(outcomes):
+    for _, error in outcomes:
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+
+def run_concurrently(function, items, workers):
+    """Calls function on each item using up to workers threads, returns the
+    results in the order of items. Every item is called even when some of
+    the calls fail, the first error is then raised"""
+    outcomes = map_concurrently(function, items, workers)
+    raise_first_error(outcomes)
+    return [result for result, _ in outcomes]
+
+
 def check_expected(expected, actual, what, index):
     if (expected == actual):
         return True
@@ -89,7 +135,7 @@ def set_if_not_env(name, default):
 def setup_cli():
     api_host = get_api_host()
 
-    # These need to be set because we are invoking the CLI as a process
+    # These need to be set for both the CLI process and in process client
     set_if_not_env('OS_USERNAME', OS_USERNAME)
     set_if_not_env('OS_PASSWORD', OS_PASSWORD)
     set_if_not_env('OS_PROJECT_NAME', OS_PROJECT_NAME)
@@ -108,26 +154,16 @@ def ensure_has_notification_engine():
     return True
 
 
+def get_mailbox(user):
+    if user not in mailboxes:
+        mailboxes[user] = mail_spool.Mailbox('/var/mail/' + user)
+    return mailboxes[user]
+
+
+def skip_existing_notifications(user):
+    """Only notifications mailed after this call will be found"""
+    get_mailbox(user).skip_existing()
+
+
 def find_notifications(alarm_id, user):
-    args = ['sudo', 'cat', '/var/mail/' + user]
-    result = []
-    env = os.environ.copy()
-    env['PYTHONIOENCODING'] = "utf-8"
-    try:
-        stdout = subprocess.check_output(args, env=env)
-    except subprocess.CalledProcessError as e:
-        print(e, file=sys.stderr)
-        sys.exit(1)
-
-    previous = ''
-    for line in stdout.splitlines():
-        # Get the state; the alarm_id always follows the state message
-        line = unicode(line, "utf-8")
-        if alarm_id in line:
-            """ In the notification message the state verb is framed by
-            'transitioned to the ' and ' state'
-            """
-            result.append(re.search('transitioned to the (.+?) state',
-                                    previous).group(1))
-        previous = line
-    return result
+    return get_mailbox(user).find(alarm_id)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+""" Polling with backoff for the wait loops in the smoke tests.
+
+    Every wait is recorded in waits, and as a timing span, so the time taken
+    to reach each condition can be reported at the end of a run.
+"""
+from __future__ import print_function
+import random
+import time
+import timing
+
+waits = []
+
+
+class Backoff(object):
+    """Delays between polls start short and grow by factor up to maximum.
+
+    Each delay is randomly stretched or shrunk by up to jitter (a fraction)
+    so concurrent waiters don't poll the API in lock step.
+    """
+
+    def __init__(self, initial=0.25, factor=1.5, maximum=4.0, jitter=0.2):
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+
+    def delays(self):
+        delay = self.initial
+        while True:
+            yield delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+            delay = min(delay * self.factor, self.maximum)
+
+
+DEFAULT_BACKOFF = Backoff()
+
+
+class WaitResult(object):
+    def __init__(self, description, value, elapsed, attempts):
+        self.description = description
+        self.value = value
+        self.elapsed = elapsed
+        self.attempts = attempts
+
+    @property
+    def satisfied(self):
+        return bool(self.value)
+
+
+def record(description, value, elapsed, attempts=1):
+    result = WaitResult(description, value, elapsed, attempts)
+    waits.append(result)
+    timing.record(description, 'wait', time.time() - elapsed, elapsed,
+                  None if result.satisfied else 'timed out')
+    return result
+
+
+def wait_for(predicate, timeout, description, backoff=DEFAULT_BACKOFF):
+    """Calls predicate until it returns a true value or timeout seconds
+    have passed.
+
+    The predicate is called right away and then after each backoff delay,
+    with the last call made at the deadline. Returns a WaitResult whose
+    value is the last value returned by predicate.
+    """
+    start = time.time()
+    deadline = start + timeout
+    attempts = 0
+    delays = backoff.delays()
+    while True:
+        attempts += 1
+        value = predicate()
+        now = time.time()
+        if value or now >= deadline:
+            return record(description, value, now - start, attempts)
+        time.sleep(min(next(delays), deadline - now))
+
+
+def print_summary():
+    print('Wait times:')
+    for result in waits:
+        print('\t{:<60} {:>8.2f}s {:>4} polls {}'.format(
+              result.description, result.elapsed, result.attempts,
+              'ok' if result.satisfied else 'TIMED OUT'))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+""" A small HTTP server that receives webhook notifications so they can be
+    checked without going through email.
+
+    Every POST is timestamped on arrival and indexed by the alarm_id in its
+    JSON body.
+"""
+from __future__ import print_function
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+
+
+class Notification(object):
+    def __init__(self, payload, received):
+        self.payload = payload
+        self.received = received
+        self.alarm_id = payload.get('alarm_id')
+        self.state = payload.get('state')
+        self.old_state = payload.get('old_state')
+
+    @property
+    def alarm_timestamp(self):
+        """When the alarm changed state in seconds, if the payload says"""
+        timestamp = self.payload.get('alarm_timestamp')
+        if timestamp is None:
+            return None
+        timestamp = float(timestamp)
+        # Older notification engines send milliseconds
+        if timestamp > 1e11:
+            timestamp = timestamp / 1000
+        return timestamp
+
+    @property
+    def latency(self):
+        """Seconds from the state change to the notification arriving"""
+        if self.alarm_timestamp is None:
+            return None
+        return self.received - self.alarm_timestamp
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        received = time.time()
+        length = int(self.headers.getheader('content-length', 0))
+        body = self.rfile.read(length)
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+        self.server.sink.add(Notification(payload, received))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class WebhookSink(object):
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = _Server((host, port), _Handler)
+        self.server.sink = self
+        self.condition = threading.Condition()
+        self.by_alarm = {}
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add(self, notification):
+        with self.condition:
+            self.by_alarm.setdefault(notification.alarm_id, []).append(
+                notification)
+            self.condition.notify_all()
+
+    def notifications(self, alarm_id):
+        with self.condition:
+            return list(self.by_alarm.get(alarm_id, []))
+
+    def wait_for(self, alarm_id, count, timeout):
+        """Waits until count notifications arrived for the alarm or timeout
+        seconds passed, returns the notifications received"""
+        deadline = time.time() + timeout
+        with self.condition:
+            while len(self.by_alarm.get(alarm_id, [])) < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return list(self.by_alarm.get(alarm_id, []))